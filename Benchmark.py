@@ -0,0 +1,553 @@
+"""
+Offline benchmark for the harvester. Starts a mock Clash of Clans API on localhost, points a
+FetchSession at it (COC_API_URL) with a SQLite stand-in for MariaDB, and drives the real clan,
+clanWar/attack and warResults code through a few synthetic cycles.
+
+    python Benchmark.py --clans 20 --members 50 --cycles 3 --latency 40 --p429 0.01
+
+Per job it reports wall time, API requests and requests/sec, DB round trips and rows written,
+and peak Python memory (tracemalloc, which slows everything a little; compare runs with each other,
+not with production).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from DBManager import DBManager
+
+
+# --- Synthetic world -------------------------------------------------------------------------
+
+class MockWorld:
+    """
+    Tracked clans with full rosters, one war each against an untracked opponent, and players whose
+    counters move every tick. tick() advances everything: some players donate, some members leave
+    and are replaced, and each war reveals more attacks until it ends on the last cycle.
+    """
+
+    def __init__(self, clans, members, war_size, cycles, active, churn, seed=1):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.cycles = cycles
+        self.active = active
+        self.churn = churn
+        self.tick_no = 0
+        self.joined = 0
+
+        self.clans = {}
+        self.players = {}
+        for i in range(clans):
+            tag = f"#C{i:05d}"
+            self.clans[tag] = {"name": f"Bench Clan {i}", "level": 1 + i % 20, "members": []}
+            for j in range(members):
+                self.join(tag, f"#P{i:05d}{j:03d}")
+
+        start = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=12)
+        self.wars = {tag: self.makeWar(tag, min(war_size, members), start) for tag in self.clans}
+
+    def join(self, clanTag, playerTag):
+        self.clans[clanTag]["members"].append(playerTag)
+        self.players[playerTag] = {
+            "tag": playerTag, "name": f"Player {playerTag[2:]}", "clan": {"tag": clanTag},
+            "townHallLevel": self.random.randint(8, 16), "expLevel": self.random.randint(50, 250),
+            "warStars": self.random.randint(0, 1500), "builderHallLevel": self.random.randint(3, 10),
+            "builderBaseTrophies": self.random.randint(1000, 5000), "role": "member", "warPreference": "in",
+            "donations": 0, "donationsReceived": 0, "clanCapitalContributions": 0,
+        }
+
+    def makeWar(self, tag, size, start):
+        opponent = "#O" + tag[2:]
+        ours = [{"tag": t, "name": self.players[t]["name"], "mapPosition": n + 1,
+                 "townhallLevel": self.players[t]["townHallLevel"]} for n, t in enumerate(self.clans[tag]["members"][:size])]
+        theirs = [{"tag": f"{opponent}{n:03d}", "name": f"Opponent {n}", "mapPosition": n + 1,
+                   "townhallLevel": self.random.randint(8, 16)} for n in range(size)]
+
+        # Every member attacks twice; attacks are revealed in this order over the cycles
+        attacks = []
+        for attackers, defenders in ((ours, theirs), (theirs, ours)):
+            for n, m in enumerate(attackers):
+                for d in (defenders[n], defenders[(n + 1) % size]):
+                    attacks.append((m["tag"], {"attackerTag": m["tag"], "defenderTag": d["tag"],
+                                               "stars": self.random.randint(0, 3),
+                                               "destructionPercentage": self.random.randint(30, 100),
+                                               "duration": self.random.randint(60, 180)}))
+        self.random.shuffle(attacks)
+
+        return {"tag": tag, "opponent": opponent, "size": size, "ours": ours, "theirs": theirs,
+                "attacks": attacks, "start": start, "end": start + timedelta(hours=24)}
+
+    def tick(self):
+        with self.lock:
+            self.tick_no += 1
+            for p in self.players.values():
+                if self.random.random() < self.active:
+                    p["donations"] += self.random.randint(1, 20)
+                    p["donationsReceived"] += self.random.randint(0, 10)
+
+            for tag, c in self.clans.items():
+                if self.random.random() < self.churn and c["members"]:
+                    gone = c["members"].pop(self.random.randrange(len(c["members"])))
+                    self.players[gone]["clan"] = None
+                    self.joined += 1
+                    self.join(tag, f"#N{self.joined:08d}")
+
+    def clan(self, tag):
+        c = self.clans.get(tag)
+        if c is None:
+            return None
+        return {"tag": tag, "name": c["name"], "clanLevel": c["level"],
+                "memberList": [{"tag": t, "name": self.players[t]["name"]} for t in c["members"]]}
+
+    def members(self, tag):
+        c = self.clans.get(tag)
+        if c is None:
+            return None
+        return {"items": [{k: self.players[t][k] for k in ("tag", "name", "role", "expLevel", "donations",
+                                                          "donationsReceived", "builderBaseTrophies")}
+                          for t in c["members"]]}
+
+    def player(self, tag):
+        p = self.players.get(tag)
+        if p is None:
+            return None
+        # Players who left have no clan key at all, as in the real API
+        return {k: v for k, v in p.items() if v is not None}
+
+    def currentWar(self, tag):
+        war = self.wars.get(tag)
+        if war is None:
+            return None
+        with self.lock:
+            ended = self.tick_no >= self.cycles
+            shown = len(war["attacks"]) * min(self.tick_no + 1, self.cycles) // self.cycles
+
+        revealed = {}
+        for attacker, atk in war["attacks"][:shown]:
+            revealed.setdefault(attacker, []).append(atk)
+
+        def side(clanTag, name, members):
+            return {"tag": clanTag, "name": name, "clanLevel": 10,
+                    "members": [dict(m, attacks=revealed.get(m["tag"], [])) for m in members]}
+
+        stamp = "%Y%m%dT%H%M%S.000Z"
+        return {"state": "warEnded" if ended else "inWar", "teamSize": war["size"],
+                "startTime": war["start"].strftime(stamp), "endTime": war["end"].strftime(stamp),
+                "clan": side(tag, self.clans[tag]["name"], war["ours"]),
+                "opponent": side(war["opponent"], f"Opponent of {tag}", war["theirs"])}
+
+    def seedHistory(self, db, wars):
+        """Ended wars with attacks but no WarResults, so warResults.checkWarEnded has a backlog."""
+        start = datetime.now() - timedelta(days=30)
+        with db.transaction() as tx:
+            for n in range(wars):
+                tag = list(self.clans)[n % len(self.clans)]
+                war = self.makeWar(tag, self.wars[tag]["size"], start - timedelta(days=2 * n))
+                warID = tx.execute("""
+                    INSERT INTO ClanWar(clanTag1,clanTag2,state,teamSize,startTime,endTime,warType,leagueGroupId,league)
+                    Values(?,?,?,?,?,?,?,?,?)
+                    """, (tag, war["opponent"], "warEnded", war["size"], war["start"], war["end"], "Standard", None, None))
+                tx.executemany("INSERT IGNORE INTO WarPlayer (warID,playerTag,mapPosition,townHallLevel,name,clanTag) "
+                               "VALUES (?,?,?,?,?,?)",
+                               [(warID, m["tag"], m["mapPosition"], m["townhallLevel"], m["name"], clanTag)
+                                for members, clanTag in ((war["ours"], tag), (war["theirs"], war["opponent"]))
+                                for m in members])
+                tx.executemany("INSERT IGNORE INTO Attack (warID, attackerTag, defenderTag, stars, destruction, startTime, "
+                               "duration) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               [(warID, a["attackerTag"], a["defenderTag"], a["stars"], a["destructionPercentage"],
+                                 war["start"] + timedelta(hours=1), a["duration"]) for _, a in war["attacks"]])
+
+
+# --- Mock API server -------------------------------------------------------------------------
+
+class MockAPI(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+    disable_nagle_algorithm = True  # Headers and body go out in separate writes
+
+    ROUTES = [
+        (re.compile(r"^/v1/clans/([^/]+)/members$"), "members"),
+        (re.compile(r"^/v1/clans/([^/]+)/currentwar$"), "currentWar"),
+        (re.compile(r"^/v1/clans/([^/]+)$"), "clan"),
+        (re.compile(r"^/v1/players/([^/]+)$"), "player"),
+    ]
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        server.count()
+
+        roll = server.random()
+        if roll < server.p429:
+            return self.reply(429, {"reason": "requestThrottled"}, {"Retry-After": str(server.retry_after)})
+        if roll < server.p429 + server.p403:
+            return self.reply(403, {"reason": "accessDenied.invalidIp"})
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        for pattern, method in self.ROUTES:
+            match = pattern.match(path)
+            if match:
+                data = getattr(server.world, method)(match.group(1))
+                break
+        else:
+            data = None
+        if data is None:
+            return self.reply(404, {"reason": "notFound"})
+
+        body = json.dumps(data).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        headers = {"ETag": etag, "Cache-Control": f"max-age={server.max_age}"}
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, None, headers)
+        self.reply(200, body, headers)
+
+    def reply(self, status, body, headers=None):
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body or b"")))
+        self.end_headers()
+        if body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Thousands of requests per cycle
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, world, latency=0.0, p403=0.0, p429=0.0, retry_after=1, max_age=0, seed=1):
+        super().__init__(("127.0.0.1", 0), MockAPI)
+        self.world = world
+        self.latency = latency
+        self.p403 = p403
+        self.p429 = p429
+        self.retry_after = retry_after
+        self.max_age = max_age
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="MockAPI", daemon=True).start()
+        return self
+
+
+class BenchKeys:
+    """KeyManager stand-in: a 403 'refreshes' instantly by bumping the generation."""
+
+    def __init__(self, count=3):
+        self.lock = threading.Lock()
+        self.generation = 1
+        self.refreshes = 0
+        self.keys = [f"bench-key-{n}" for n in range(count)]
+        self.n = 0
+
+    def next(self):
+        with self.lock:
+            self.n += 1
+            return self.keys[self.n % len(self.keys)], self.generation
+
+    def refresh(self, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.generation += 1
+                self.refreshes += 1
+
+
+# --- SQLite stand-in for MariaDB -------------------------------------------------------------
+
+sqlite3.register_adapter(datetime, lambda t: t.isoformat(" "))
+sqlite3.register_converter("DATETIME", lambda b: datetime.fromisoformat(b.decode()))
+
+
+def translate(sql, primaryKeys):
+    """Rewrites the MariaDB syntax the harvester uses into SQLite. primaryKeys(table) -> [columns]."""
+    sql = sql.strip().rstrip(";")
+    sql = re.sub(r"\bENGINE\s*=\s*\w+", "", sql)
+    sql = re.sub(r"\bINT\s+AUTO_INCREMENT\s+PRIMARY\s+KEY\b", "INTEGER PRIMARY KEY AUTOINCREMENT", sql)
+    sql = re.sub(r",\s*INDEX\s*\([^)]*\)", "", sql)  # Inline secondary indexes
+    sql = re.sub(r"\bINSERT\s+IGNORE\b", "INSERT OR IGNORE", sql)
+    sql = re.sub(r"\bNOW\(\)", "datetime('now', 'localtime')", sql)
+    sql = re.sub(r"^(DROP\s+INDEX\s+IF\s+EXISTS\s+\w+)\s+ON\s+\w+$", r"\1", sql)
+    sql = re.sub(r"\s+FOR\s+UPDATE$", "", sql)  # BEGIN IMMEDIATE already serialises writers
+
+    match = re.search(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", sql)
+    if match:
+        table = re.search(r"\bINTO\s+(\w+)", sql).group(1)
+        updates = re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1", sql[match.end():])
+        sql = f"{sql[:match.start()]} ON CONFLICT({', '.join(primaryKeys(table))}) DO UPDATE SET {updates}"
+    return sql
+
+
+class LiteCursor:
+    def __init__(self, db, cursor):
+        self.db = db
+        self.cursor = cursor
+        self.generated = False  # Last statement inserted into an AUTO_INCREMENT table
+
+    def execute(self, query, params=()):
+        self.db.record(1, 0)
+        self.generated = False
+        sql = self.db.translate(query)
+        if isinstance(sql, list):
+            for statement in sql:
+                self.cursor.execute(statement)
+            return
+        self.cursor.execute(sql, params)
+        self.generated = self.db.autoIncrement(query) and self.cursor.rowcount > 0
+
+    def executemany(self, query, rows):
+        self.db.record(1, len(rows))  # One round trip on MariaDB
+        self.generated = False
+        self.cursor.executemany(self.db.translate(query), rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def lastrowid(self):
+        # Like mariadb's connector: None unless the statement generated an AUTO_INCREMENT id.
+        # SQLite's rowid would make every write look like it returned an id.
+        return self.cursor.lastrowid if self.generated else None
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+class LiteConnection:
+    # Just enough of a mariadb connection for DBManager: autocommit toggling, commit/rollback, ping
+    def __init__(self, db):
+        self.db = db
+        self.conn = sqlite3.connect(db.path, timeout=60, isolation_level=None, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+    @property
+    def autocommit(self):
+        return not self.conn.in_transaction
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if not value:
+            self.conn.execute("BEGIN IMMEDIATE")  # Take the write lock up front; SQLite has one writer
+
+    def commit(self):
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+
+    def rollback(self):
+        if self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+
+    def ping(self):
+        pass
+
+    def cursor(self):
+        return LiteCursor(self.db, self.conn.cursor())
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteDB(DBManager):
+    """DBManager on a local SQLite file. Counts round trips and rows so cycles can be compared."""
+
+    def __init__(self, path, pool_size=None):
+        self.path = path
+        self.statements = {}
+        self.keys = {}
+        self.serial = {}  # table -> has an AUTO_INCREMENT column
+        self.countLock = threading.Lock()
+        self.queries = 0
+        self.rows = 0
+        super().__init__(None, None, None, None, pool_size)
+
+    def connect(self):
+        return LiteConnection(self)
+
+    def record(self, queries, rows):
+        with self.countLock:
+            self.queries += queries
+            self.rows += rows
+
+    def primaryKeys(self, table):
+        if table not in self.keys:
+            conn = sqlite3.connect(self.path)
+            info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+            conn.close()
+            self.keys[table] = [row[1] for row in sorted(info, key=lambda r: r[5]) if row[5]]
+        return self.keys[table]
+
+    def autoIncrement(self, query):
+        match = re.match(r"\s*INSERT\b.*?\bINTO\s+(\w+)", query, re.IGNORECASE | re.DOTALL)
+        if not match:
+            return False
+        table = match.group(1)
+        if table not in self.serial:
+            conn = sqlite3.connect(self.path)
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+            conn.close()
+            self.serial[table] = bool(row) and "AUTOINCREMENT" in row[0].upper()
+        return self.serial[table]
+
+    def translate(self, query):
+        sql = self.statements.get(query)
+        if sql is None:
+            rekey = re.match(r"\s*ALTER\s+TABLE\s+(\w+)\s+DROP\s+PRIMARY\s+KEY\s*,\s*ADD\s+PRIMARY\s+KEY\s*\(([^)]*)\)",
+                             query, re.IGNORECASE)
+            sql = self.rekey(*rekey.groups()) if rekey else translate(query, self.primaryKeys)
+            self.statements[query] = sql
+        return sql
+
+    def rekey(self, table, columns):
+        # SQLite can't change a primary key in place: copy the rows into a re-keyed table
+        conn = sqlite3.connect(self.path)
+        create = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+        conn.close()
+        self.keys.pop(table, None)
+        return [f"ALTER TABLE {table} RENAME TO {table}_rekey",
+                re.sub(r"PRIMARY KEY\s*\([^)]*\)", f"PRIMARY KEY ({columns})", create, count=1),
+                f"INSERT OR IGNORE INTO {table} SELECT * FROM {table}_rekey",
+                f"DROP TABLE {table}_rekey"]
+
+    def createSchema(self, path="database.txt"):
+        with open(path) as f:
+            # Whole-line comments go first, some of them contain semicolons
+            script = "\n".join(line for line in f if not line.strip().startswith("--"))
+        conn = sqlite3.connect(self.path)
+        for statement in script.split(";"):
+            if statement.strip():
+                conn.execute(translate(statement, self.primaryKeys))
+        conn.commit()
+        conn.close()
+
+
+# --- Driver ----------------------------------------------------------------------------------
+
+class Bench:
+    def __init__(self, server, db, session):
+        self.server = server
+        self.db = db
+        self.session = session
+        self.results = []
+
+    def measure(self, cycle, job, fn):
+        requests, queries, rows = self.server.requests, self.db.queries, self.db.rows
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        fn()
+        wall = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+
+        requests = self.server.requests - requests
+        result = {"cycle": cycle, "job": job, "wall": wall, "requests": requests,
+                  "rps": requests / wall if wall else 0, "queries": self.db.queries - queries,
+                  "rows": self.db.rows - rows, "peakMB": peak / 2 ** 20}
+        self.results.append(result)
+        print(f"{cycle:>5} {job:<12} {wall:>8.2f}s {requests:>8} {result['rps']:>9.1f} "
+              f"{result['queries']:>8} {result['rows']:>8} {result['peakMB']:>8.1f}")
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline harvester benchmark against a mock API.")
+    parser.add_argument("--clans", type=int, default=10)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--war-size", type=int, default=15)
+    parser.add_argument("--cycles", type=int, default=3, help="activity/snapshot/war cycles after the first crawl")
+    parser.add_argument("--history-wars", type=int, default=50, help="ended wars without results to seed")
+    parser.add_argument("--active", type=float, default=0.3, help="share of players whose counters move per tick")
+    parser.add_argument("--churn", type=float, default=0.2, help="chance per clan per tick that a member is replaced")
+    parser.add_argument("--latency", type=float, default=30, help="mock API latency in ms")
+    parser.add_argument("--p403", type=float, default=0.0)
+    parser.add_argument("--p429", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    parser.add_argument("--max-age", type=int, default=0, help="Cache-Control max-age the mock API sends")
+    parser.add_argument("--rate", type=float, default=1000, help="API_RATE for the session")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    world = MockWorld(args.clans, args.members, args.war_size, args.cycles, args.active, args.churn)
+    server = MockServer(world, args.latency / 1000, args.p403, args.p429, args.retry_after, args.max_age).start()
+
+    # Imported late: Fetcher reads its settings from the environment at import and at session creation
+    os.environ["COC_API_URL"] = server.url
+    os.environ.setdefault("API_RATE", str(args.rate))
+    # Real cycles are minutes apart; here they run back to back, so don't let activity reuse snapshot fetches
+    os.environ.setdefault("PLAYER_REUSE_SECONDS", "0")
+    from Fetcher import FetchSession, clan, attack, warResults
+    from Migrations import migrate
+
+    workdir = tempfile.mkdtemp(prefix="harvester-bench-")
+    db = SQLiteDB(os.path.join(workdir, "bench.db"))
+    db.createSchema()
+    migrate(db)
+    world.seedHistory(db, args.history_wars)
+
+    keys = BenchKeys()
+    session = FetchSession(token="bench", keys=keys, db=db)
+    bench = Bench(server, db, session)
+    tags = list(world.clans)
+
+    tracemalloc.start()
+    print(f"{'cycle':>5} {'job':<12} {'wall':>9} {'requests':>8} {'req/s':>9} {'queries':>8} {'rows':>8} {'peakMB':>8}")
+
+    clans = []
+    bench.measure(0, "crawl", lambda: clans.extend(clan(t, session) for t in tags))
+    for cycle in range(1, args.cycles + 1):
+        world.tick()
+        bench.measure(cycle, "activity", lambda: [c.savePlayersActivity() for c in clans])
+        bench.measure(cycle, "snapshot", lambda: [c.savePlayersSnapshot() for c in clans])
+        bench.measure(cycle, "wars", lambda: attack.saveAttacks(session, tags))
+        bench.measure(cycle, "warResults", lambda: warResults.checkWarEnded(session))
+
+    tracemalloc.stop()
+    print(f"\nlimiter {session.limiter.stats()}")
+    print(f"cache   {session.cache.stats()}")
+    print(f"keys    {keys.refreshes} refreshes")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": bench.results}, f, indent=2)
+
+    if session.client is not None:
+        asyncio.run_coroutine_threadsafe(session.client.close(), session.loop).result()
+    server.shutdown()
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
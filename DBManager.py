@@ -1,52 +1,222 @@
 import mariadb
 import sys
-import threading  # <--- Import this
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from os import environ
+from Metrics import observeQuery
+from Profiler import record
+
+
+def fetchResult(cursor, query):
+    if query.strip().upper().startswith(("SELECT", "EXPLAIN", "SHOW")):
+        return cursor.fetchall()
+    return cursor.lastrowid
+
+
+class Transaction:
+    # Same execute() contract as DBManager, but every statement runs on one connection
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        failed = True
+        try:
+            self.cursor.execute(query, params or ())
+            result = fetchResult(self.cursor, query)
+            failed = False
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            observeQuery(query, elapsed, failed=failed)
+            record("db round trip", elapsed)
+
+    def executemany(self, query, rows):
+        if rows:
+            started = time.perf_counter()
+            failed = True
+            try:
+                self.cursor.executemany(query, rows)
+                failed = False
+            finally:
+                elapsed = time.perf_counter() - started
+                observeQuery(query, elapsed, len(rows), failed)
+                record("db round trip", elapsed)
+
+    @property
+    def rowcount(self):
+        # Rows affected by the last statement
+        return self.cursor.rowcount
 
 
 class DBManager:
-    def __init__(self, host, user, password, database):
-        self.lock = threading.Lock()  # <--- Create a Lock
-        try:
-            self.conn = mariadb.connect(
-                host=host,
-                user=user,
-                password=password,
-                database=database
-            )
-            self.conn.autocommit = True  # Helps with threading
+    def __init__(self, host, user, password, database, pool_size=None):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.database = database
+
+        # Every job thread borrows its own connection, so queries never share a cursor
+        if pool_size is None:
+            pool_size = int(environ.get("DB_POOL_SIZE", 8))
+        self.pool_size = pool_size
+        self.pool = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+
+        # Write buffer is per thread, so each job flushes (and commits) only its own rows
+        self.buffer_rows = int(environ.get("DB_BUFFER_ROWS", 500))
+        self.buffer_seconds = float(environ.get("DB_BUFFER_SECONDS", 30))
+        self.local = threading.local()
+        # Called with {query: rows} when a flush fails, so whoever remembered those rows as written can forget them
+        self.dropHandlers = []
+
+        try:
+            self.pool.put(self.connect())  # Fail fast at boot if the DB is unreachable
         except mariadb.Error as e:
             print(f"Error connecting to MariaDB: {e}")
             sys.exit(1)
 
-    def execute(self, query, params=None):
+    def connect(self):
+        conn = mariadb.connect(
+            host=self.host,
+            user=self.user,
+            password=self.password,
+            database=self.database
+        )
+        conn.autocommit = True
+        return conn
+
+    def checkout(self):
         try:
-            # 1. PING: Check if connection is alive. Reconnect if dead.
-            self.conn.ping(reconnect=True)
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            return self.connect()  # Pool not full yet, open another one lazily
+
+        try:
+            # PING: Check if connection is alive. Reconnect if dead.
+            conn.ping()
+            return conn
         except Exception as e:
             print(f"DB Connection Lost. Reconnecting... ({e})")
             try:
-                # 2. HARD RECONNECT: Rerun the connect logic
-                self.conn = mariadb.connect(
-                    host=self.host, user=self.user,
-                    password=self.password, database=self.database
-                )
-                self.conn.autocommit = True
-            except Exception as e2:
-                print(f"Reconnect failed: {e2}")
-                return None  # Fail gracefully, don't crash
-
-        # 3. Normal Execution
-        cursor = self.conn.cursor()
-        try:
-            cursor.execute(query, params or ())
-            if query.strip().upper().startswith("SELECT"):
-                return cursor.fetchall()
-            return cursor.lastrowid
+                conn.close()
+            except Exception:
+                pass
+            return self.connect()
+
+    @contextmanager
+    def connection(self):
+        # Blocks when all pool_size connections are in use
+        self.slots.acquire()
+        conn = None
+        try:
+            conn = self.checkout()
+            yield conn
+        finally:
+            if conn is not None:
+                self.pool.put(conn)
+            self.slots.release()
+
+    def execute(self, query, params=None):
+        try:
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    return Transaction(cursor).execute(query, params)  # Same timing as in a transaction
+                except Exception as e:
+                    print(f"Query Error: {e}")
+                    return None
+                finally:
+                    cursor.close()
+        except mariadb.Error as e:
+            print(f"Reconnect failed: {e}")
+            return None  # Fail gracefully, don't crash
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.autocommit = False
+            cursor = conn.cursor()
+            try:
+                yield Transaction(cursor)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                conn.autocommit = True
+
+    def executemany(self, query, rows):
+        try:
+            with self.transaction() as tx:
+                tx.executemany(query, rows)
+            return True
         except Exception as e:
             print(f"Query Error: {e}")
-            return None
+            return False
+
+    def buffer(self, query, row):
+        """
+        Queues one row for a parameterised INSERT. Rows are grouped by statement and written
+        with executemany on flush(), or automatically once the size/age thresholds are hit.
+        """
+        pending = getattr(self.local, "pending", None)
+        if pending is None:
+            pending = self.local.pending = {}
+            self.local.count = 0
+            self.local.since = time.monotonic()
+
+        pending.setdefault(query, []).append(row)
+        self.local.count += 1
+
+        bulk = getattr(self.local, "bulk", None)
+        if bulk:
+            if self.local.count >= bulk:
+                self.flush()
+        elif (self.local.count >= self.buffer_rows or
+                time.monotonic() - self.local.since >= self.buffer_seconds):
+            self.flush()
+
+    def flush(self):
+        pending = getattr(self.local, "pending", None)
+        if pending and getattr(self.local, "bulk", None) and self.local.count < self.local.bulk:
+            return True  # Inside bulk(): per-item flushes wait for a full batch
+        self.local.pending = None
+        if not pending:
+            return True
+
+        try:
+            # One transaction for the whole batch; statements keep their first-buffered order (FKs)
+            with self.transaction() as tx:
+                for query, rows in pending.items():
+                    tx.executemany(query, rows)
+            return True
+        except Exception as e:
+            print(f"Flush Error, dropped {sum(len(r) for r in pending.values())} rows: {e}")
+            for handler in self.dropHandlers:
+                handler(pending)
+            return False
+
+    @contextmanager
+    def bulk(self, rows=None):
+        """
+        Inside the block, this thread's buffered rows are only written in batches of `rows`
+        (flush() calls from code that commits per clan or per war are deferred), and whatever
+        is left is written on exit. For backfills, where nothing reads the rows meanwhile.
+        """
+        self.local.bulk = rows or self.buffer_rows * 20
+        try:
+            yield
         finally:
-            cursor.close()
+            self.local.bulk = None
+            self.flush()
 
     def close(self):
-        self.conn.close()
\ No newline at end of file
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                break
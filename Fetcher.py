@@ -1,21 +1,498 @@
 # Fetcher.py
 from datetime import datetime
 from os import environ
+import asyncio
+import atexit
+import glob
+import gzip
+import json
+import re
+import threading
+import time
 import urllib.parse
+from collections import OrderedDict
+import aiohttp
 import dotenv
 import requests
 from DBManager import DBManager
+from Metrics import observeRequest
+from Profiler import activeCapture, span
+from Leaderboard import recordAttacks
 import os
 
 
+# "full" writes every hourly PlayerSnapshot; "delta" only writes rows whose tracked fields changed
+SNAPSHOT_MODE = environ.get("SNAPSHOT_MODE", "full")
+
+# "members" diffs activity from one clans/{tag}/members call per clan; "players" fetches every member
+ACTIVITY_MODE = environ.get("ACTIVITY_MODE", "members")
+# Activity signals; the members list carries them, players/{tag} is only needed when one is missing
+ACTIVITY_FIELDS = ("builderBaseTrophies", "donations", "donationsReceived")
+
+# Players a clan fetched this recently were just observed; an activity run skips them (0 disables)
+PLAYER_REUSE_SECONDS = float(environ.get("PLAYER_REUSE_SECONDS", 120))
+
+# Every API response is recorded to gzip JSON-lines files named after this when set (one per process,
+# e.g. capture-20240101-120000-4242.jsonl.gz for capture.jsonl.gz); Replay.py feeds them back in
+CAPTURE_FILE = environ.get("CAPTURE_FILE")
+
+# Tracked PlayerSnapshot columns, in playerSnapshot.fields() order
+SNAPSHOT_COLUMNS = ["clanTag", "townHallLevel", "exLevel", "warStars", "builderHallLevel", "builderBaseTrophies",
+                    "role", "warPreference", "donations", "donationsRecieved", "clanCapitalContributions", "league"]
+
+
+class ResponseCache:
+    """
+    LRU of API responses keyed by endpoint. Entries are fresh for the Cache-Control max-age
+    the API sent; once stale, their ETag is used to revalidate with If-None-Match.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()  # endpoint -> [data, etag, expires]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+    @staticmethod
+    def maxAge(headers):
+        control = headers.get("Cache-Control", "")
+        if "no-store" in control or "no-cache" in control:
+            return 0
+        match = re.search(r"max-age=(\d+)", control)
+        return int(match.group(1)) if match else 0
+
+    def lookup(self, endpoint):
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            if entry and entry[2] > time.monotonic():
+                self.entries.move_to_end(endpoint)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def etag(self, endpoint):
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            return entry[1] if entry else None
+
+    def store(self, endpoint, data, headers):
+        etag = headers.get("ETag")
+        max_age = self.maxAge(headers)
+        if not etag and not max_age:
+            return
+        with self.lock:
+            self.entries[endpoint] = [data, etag, time.monotonic() + max_age]
+            self.entries.move_to_end(endpoint)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def revalidate(self, endpoint, headers):
+        # 304 Not Modified: keep the body, restart the freshness window
+        with self.lock:
+            entry = self.entries.get(endpoint)
+            if not entry:
+                return None
+            entry[2] = time.monotonic() + self.maxAge(headers)
+            self.entries.move_to_end(endpoint)
+            self.revalidated += 1
+            return entry[0]
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "misses": self.misses, "revalidated": self.revalidated}
+
+
+class ResponseRecorder:
+    """
+    Capture of API responses, one JSON line per response: when it arrived, the endpoint, the status
+    and the body. A 304 is written with the cached body it resolved to, so a capture replays without
+    the cache. Every process writes a file of its own (never appends to one a crashed run left
+    unterminated), so a crash loses at most the last flush_seconds of that process's file.
+    """
+
+    def __init__(self, path, flush_seconds=5):
+        self.path = ResponseRecorder.processPath(path)
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.file = gzip.open(self.path, "xt", encoding="utf-8")
+        self.flushed = time.monotonic()
+        self.records = 0
+        atexit.register(self.close)  # Writes the gzip trailer
+
+    @staticmethod
+    def splitPath(path):
+        for ext in (".jsonl.gz", ".gz"):
+            if path.endswith(ext):
+                return path[:-len(ext)], ext
+        return path, ".jsonl.gz"
+
+    @staticmethod
+    def processPath(path):
+        """CAPTURE_FILE with this process's start time and pid inserted before the extension."""
+        root, ext = ResponseRecorder.splitPath(path)
+        return f"{root}-{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}{ext}"
+
+    @staticmethod
+    def processFiles(path):
+        """Every file processPath() made from path, oldest first."""
+        root, ext = ResponseRecorder.splitPath(path)
+        return sorted(glob.glob(f"{glob.escape(root)}-*-*{ext}"))
+
+    def record(self, endpoint, status, data):
+        body = json.dumps(data, separators=(",", ":"))
+        with self.lock:
+            if self.file is None:
+                return
+            # Stamped under the lock so a file's records are in time order across threads
+            self.file.write(f'{{"time":"{datetime.now().isoformat(timespec="milliseconds")}",'
+                            f'"endpoint":{json.dumps(endpoint)},"status":{status},"data":{body}}}\n')
+            self.records += 1
+            if time.monotonic() - self.flushed >= self.flush_seconds:
+                self.file.flush()  # Sync flush: everything so far is readable even if we die
+                self.flushed = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class EntityIndex:
+    """
+    In-memory copy of the Clan and Player tables (warmed from the DB on first use), so existence
+    checks cost nothing and upserts are only sent when a row actually changed.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.clans = None  # tag -> (name, level)
+        self.players = None  # playerTag -> (clanTag, name)
+        self.attacks = {}  # warID -> {(attackerTag, defenderTag)} for wars still being polled
+        self.rosters = set()  # warIDs whose WarPlayer rows are already stored
+
+    def warm(self):
+        with self.lock:
+            if self.clans is not None:
+                return
+            rows = self.db.execute("SELECT tag, name, level FROM Clan;") or []
+            self.clans = {r[0]: (r[1], r[2]) for r in rows}
+            rows = self.db.execute("SELECT playerTag, clanTag, name FROM Player;") or []
+            self.players = {r[0]: (r[1], r[2]) for r in rows}
+
+    def hasClan(self, tag):
+        self.warm()
+        return tag in self.clans
+
+    def write(self, sql, params):
+        # DBManager.execute returns lastrowid, which is None for UPDATEs and tables without
+        # AUTO_INCREMENT, so a write counts as done when it didn't raise
+        try:
+            with self.db.transaction() as tx:
+                tx.execute(sql, params)
+            return True
+        except Exception as e:
+            print(f"Query Error: {e}")
+            return False
+
+    def saveClan(self, tag, name, level):
+        self.warm()
+        if self.clans.get(tag) == (name, level):
+            return
+        sql = """
+        INSERT INTO Clan(tag,name,level) Values(?,?,?)
+        ON DUPLICATE KEY UPDATE name = VALUES(name), level = VALUES(level)
+        """
+        if self.write(sql, (tag, name, level)):
+            with self.lock:
+                self.clans[tag] = (name, level)
+
+    def savePlayer(self, playerTag, clanTag, name):
+        self.warm()
+        if self.players.get(playerTag) == (clanTag, name):
+            return
+        sql = """
+        INSERT INTO Player(playerTag, clanTag, name) Values(?, ?, ?)
+        ON DUPLICATE KEY UPDATE clanTag = VALUES(clanTag), name = VALUES(name)
+        """
+        if self.write(sql, (playerTag, clanTag, name)):
+            with self.lock:
+                self.players[playerTag] = (clanTag, name)
+
+    def attackKeys(self, warID, tx):
+        """
+        Stored (attacker, defender) pairs for a war, read in the transaction holding its ClanWar row lock.
+        Another thread or worker may have stored attacks since the cached set was taken, so it is
+        checked against the stored count (an index-only COUNT) and re-read when they differ.
+        """
+        with self.lock:
+            keys = self.attacks.get(warID)
+        if keys is not None and tx.execute("SELECT COUNT(*) FROM Attack WHERE warID = ?", (warID,))[0][0] != len(keys):
+            keys = None
+        if keys is None:
+            rows = tx.execute("SELECT attackerTag, defenderTag FROM Attack WHERE warID = ?", (warID,))
+            keys = {(row[0], row[1]) for row in rows or []}
+            with self.lock:
+                self.attacks[warID] = keys
+        return frozenset(keys)
+
+    def hasRoster(self, warID):
+        with self.lock:
+            return warID in self.rosters
+
+    def commitWar(self, warID, keys, ended=False):
+        # Called only after the ingesting transaction committed, so every key is a stored row
+        with self.lock:
+            if ended:
+                self.attacks.pop(warID, None)  # Ended wars are never polled again
+                self.rosters.discard(warID)
+            else:
+                self.attacks.setdefault(warID, set()).update(keys)
+                self.rosters.add(warID)
+
+    def clan(self, tag):
+        self.warm()
+        return self.clans.get(tag)
+
+    def members(self, clanTag):
+        return [tag for tag, _ in self.roster(clanTag)]
+
+    def roster(self, clanTag):
+        """
+        (playerTag, name) for the players stored under clanTag. Read from the DB, since other workers
+        move players between clans too; the copy is corrected to match so savePlayer won't skip a write.
+        """
+        self.warm()
+        rows = self.db.execute("SELECT playerTag, name FROM Player WHERE clanTag = ?", (clanTag,))
+        with self.lock:
+            if rows is None:
+                # DB hiccup: the copy is the best we have
+                return [(tag, name) for tag, (c, name) in self.players.items() if c == clanTag]
+            stored = {row[0]: row[1] for row in rows}
+            for tag, (c, _) in list(self.players.items()):
+                if c == clanTag and tag not in stored:
+                    del self.players[tag]  # Moved elsewhere; the next savePlayer for them writes
+            for tag, name in stored.items():
+                self.players[tag] = (clanTag, name)
+            return list(stored.items())
+
+    def leaveClan(self, playerTag, clanTag):
+        # Only while they are still stored under the clan they left: another worker may
+        # already have written their new clan
+        self.warm()
+        update_sql = "UPDATE Player SET clanTag = NULL WHERE playerTag = ? AND clanTag = ?"
+        if self.write(update_sql, (playerTag, clanTag)):
+            with self.lock:
+                cached = self.players.get(playerTag)
+                if cached and cached[0] == clanTag:
+                    self.players[playerTag] = (None, cached[1])
+
+
+class PlayerState:
+    __slots__ = ('builderBaseTrophies', 'donations', 'donationsReceived', 'snapshotHash')
+
+    def __init__(self, builderBaseTrophies, donations, donationsReceived, snapshotHash=None):
+        self.builderBaseTrophies = builderBaseTrophies
+        self.donations = donations
+        self.donationsReceived = donationsReceived
+        self.snapshotHash = snapshotHash  # hash of the last stored snapshot's tracked fields
+
+
+class PlayerStateStore:
+    """
+    Last observed activity counters per player, plus a hash of the last stored snapshot.
+    Seeded once from each player's latest PlayerSnapshot, then updated by every observation,
+    so activity checks and delta snapshots never hit the DB. Rows are buffered, so a failed
+    flush hands its rows back to dropped() and the state they recorded is undone.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.lock = threading.Lock()
+        self.states = None  # playerTag -> PlayerState
+        db.dropHandlers.append(self.dropped)
+
+    def warm(self):
+        with self.lock:
+            if self.states is not None:
+                return
+            sql = f"""
+            SELECT ps.playerTag, {", ".join("ps." + c for c in SNAPSHOT_COLUMNS)}
+            FROM PlayerSnapshot ps
+            JOIN (SELECT playerTag, MAX(time) AS time FROM PlayerSnapshot GROUP BY playerTag) latest
+              ON latest.playerTag = ps.playerTag AND latest.time = ps.time
+            LEFT JOIN (SELECT playerTag, MAX(time) AS time FROM PlayerDeparture GROUP BY playerTag) gone
+              ON gone.playerTag = ps.playerTag
+            WHERE gone.time IS NULL OR gone.time < ps.time;
+            """
+            rows = self.db.execute(sql) or []
+            trophies, donations, received = (SNAPSHOT_COLUMNS.index(c) + 1 for c in
+                                             ("builderBaseTrophies", "donations", "donationsRecieved"))
+            # Players who left since their last snapshot carry no state: a return is stored in full
+            self.states = {r[0]: PlayerState(r[trophies], r[donations], r[received], hash(tuple(r[1:])))
+                           for r in rows}
+
+    def observe(self, playerTag, data):
+        """Records the new counters; True if they show activity since the previous observation."""
+        self.warm()
+        trophies = data.get('builderBaseTrophies', 0)
+        donations = data.get('donations', 0)
+        received = data.get('donationsReceived', 0)
+
+        with self.lock:
+            last = self.states.get(playerTag)
+            if last is None:
+                self.states[playerTag] = PlayerState(trophies, donations, received)
+                return False
+
+            active = (last.builderBaseTrophies != trophies or
+                      last.donations < donations or
+                      last.donationsReceived < received)
+            last.builderBaseTrophies = trophies
+            last.donations = donations
+            last.donationsReceived = received
+            return active
+
+    def snapshotChanged(self, playerTag, fields):
+        """True (and remembers the new state) if these snapshot fields differ from the last stored ones."""
+        self.warm()
+        digest = hash(fields)
+        with self.lock:
+            last = self.states.get(playerTag)
+            if last is None:
+                values = dict(zip(SNAPSHOT_COLUMNS, fields))
+                last = self.states[playerTag] = PlayerState(values["builderBaseTrophies"], values["donations"],
+                                                            values["donationsRecieved"])
+            if last.snapshotHash == digest:
+                return False
+            last.snapshotHash = digest
+            return True
+
+    def forgetSnapshot(self, playerTag):
+        # After a player leaves, their next snapshot (if they come back) is always stored
+        self.warm()
+        with self.lock:
+            if playerTag in self.states:
+                self.states[playerTag].snapshotHash = None
+
+    def dropped(self, pending):
+        snapshots = pending.get(playerSnapshot.insert_sql, [])
+        activity = pending.get(player.activity_sql, [])
+        if self.states is None or not (snapshots or activity):
+            return
+        with self.lock:
+            for row in snapshots:
+                state = self.states.get(row[0])
+                if state is not None:
+                    state.snapshotHash = None  # Stored again next cycle, changed or not
+            for row in activity:
+                state = self.states.get(row[0])
+                if state is not None:
+                    state.builderBaseTrophies = None  # The next observation counts as activity
+
+
+class RateLimiter:
+    """
+    Shared by every request a FetchSession makes, from any thread or from the async engine.
+    A token bucket keeps us under `rate` requests/second, and an AIMD window caps requests in
+    flight: +1 per window of successes, halved on every 429/503. A Retry-After pauses everyone.
+    """
+
+    def __init__(self, rate, max_concurrency, retries):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.inflight = 0
+        self.paused_until = 0
+        self.retries = retries
+        self.lock = threading.Lock()
+
+        self.throttled = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def reserve(self):
+        """Takes a token and a slot if both are free; otherwise returns how long to wait."""
+        with self.lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.inflight >= int(self.limit):
+                return 0.05
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+            self.inflight += 1
+            return 0
+
+    def acquire(self):
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def acquireAsync(self):
+        while True:
+            wait = self.reserve()
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, status):
+        with self.lock:
+            self.inflight -= 1
+            if status in (429, 503):
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+            elif status is not None and status < 500:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+    def retryDelay(self, status, headers, attempt):
+        """Seconds to wait before retrying, or None if this response should not be retried."""
+        if status is not None and status != 429 and status < 500:
+            return None
+        if attempt >= self.retries:
+            with self.lock:
+                self.dropped += 1
+            return None
+
+        try:
+            delay = float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            delay = min(60, 2 ** attempt)
+
+        with self.lock:
+            self.retried += 1
+            if status == 429:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return delay
+
+    def stats(self):
+        with self.lock:
+            return {"rate": self.rate, "window": round(self.limit, 1), "inflight": self.inflight,
+                    "throttled": self.throttled, "retried": self.retried, "dropped": self.dropped}
+
 
 class FetchSession:
 
 
-    def __init__(self, token=None, email=None, password=None):
-        self.URL = "https://api.clashofclans.com/v1/"
+    def __init__(self, token=None, email=None, password=None, concurrency=None, keys=None, db=None):
+        # COC_API_URL points the harvester at another server (e.g. Benchmark.py's mock API)
+        self.URL = environ.get("COC_API_URL", "https://api.clashofclans.com/v1/").rstrip("/") + "/"
         self.email = email
         self.password = password
+        self.keys = keys  # Optional KeyManager: requests rotate across its keys instead of TOKEN
 
         # Load initial token
         if token:
@@ -29,42 +506,207 @@ class FetchSession:
             "Authorization": f"Bearer {self.TOKEN}"
         }
 
-        host = environ.get("DB_HOST")
-        password_db = environ.get("DB_PASSWORD")
-        user = environ.get("DB_USER")
-        DB = environ.get("DB_NAME")
+        # Keep-alive connection reuse for the blocking path
+        self.http = requests.Session()
+        self.tokenLock = threading.Lock()
+
+        # Async engine (getMany) runs on its own event loop thread, shared by every job
+        if concurrency is None:
+            concurrency = int(environ.get("FETCH_CONCURRENCY", 10))
+        self.concurrency = concurrency
+        self.loop = None
+        self.loopLock = threading.Lock()
+        self.client = None
+        # API_RATE is per key, so every extra key adds budget
+        key_count = len(keys.keys) if keys and keys.keys else 1
+        self.limiter = RateLimiter(float(environ.get("API_RATE", 20)) * key_count, concurrency,
+                                   int(environ.get("API_RETRIES", 3)))
+
+        self.cache = ResponseCache(int(environ.get("FETCH_CACHE_SIZE", 5000)))
+        self.recorder = ResponseRecorder(CAPTURE_FILE) if CAPTURE_FILE else None
+
+        if db is None:
+            host = environ.get("DB_HOST")
+            password_db = environ.get("DB_PASSWORD")
+            user = environ.get("DB_USER")
+            DB = environ.get("DB_NAME")
+            db = DBManager(host, user, password_db, DB)
+
+        self.db = db
+        self.index = EntityIndex(self.db)
+        self.states = PlayerStateStore(self.db)
+
+    def url(self, endpoint):
+        # Tags start with '#', which must be escaped or it becomes a URL fragment
+        return self.URL + urllib.parse.quote(endpoint)
+
+    def credential(self):
+        """(token to send, marker handed back to refreshToken if that token is rejected)"""
+        if self.keys:
+            return self.keys.next()
+        return self.TOKEN, self.TOKEN
+
+    def requestHeaders(self, endpoint, token):
+        headers = dict(self.headers)
+        headers["Authorization"] = f"Bearer {token}"
+        etag = self.cache.etag(endpoint)
+        if etag:
+            headers["If-None-Match"] = etag
+        return headers
+
+    def canRefresh(self, reason):
+        # Only a token issued for another IP is fixed by logging in; other 403s (private war logs) are final
+        return reason == "accessDenied.invalidIp" and (self.keys is not None or bool(self.email and self.password))
 
-        self.db = DBManager(host, user, password_db, DB)
+    @staticmethod
+    def forbiddenReason(body):
+        # The API explains a 403 in the body, e.g. {"reason": "accessDenied.invalidIp", ...}
+        return body.get("reason") if isinstance(body, dict) else None
+
+    def refreshToken(self, staleToken):
+        # Several threads (or coroutines) can 403 at once; only the first one logs in again
+        if self.keys:
+            self.keys.refresh(staleToken)
+            return
+        with self.tokenLock:
+            if self.TOKEN != staleToken:
+                return
+            print(f"!! 403 Forbidden. IP changed. Refreshing Token...")
+            from tracker import get_valid_token  # Import here to avoid circular imports
+            self.TOKEN = get_valid_token()
+            self.headers["Authorization"] = f"Bearer {self.TOKEN}"
 
     def getData(self, endpoint, retry=True):  # Add retry=True
-        data = None
-        try:
-
-            URL = f"https://api.clashofclans.com/v1/{endpoint}"
+        data = self.cache.lookup(endpoint)
+        if data is not None:
+            return data  # Still fresh: no request, no rate budget spent
+
+        for attempt in range(self.limiter.retries + 1):
+            self.limiter.acquire()
+            status, headers, reason = None, {}, None
+            started = time.perf_counter()
+            try:
+                token, stale = self.credential()
+                with span("api wait"):
+                    response = self.http.get(self.url(endpoint), headers=self.requestHeaders(endpoint, token))
+                status, headers = response.status_code, response.headers
+
+                if status == 200:
+                    with span("json decode"):
+                        data = response.json()
+                    self.cache.store(endpoint, data, headers)
+                    return data
+                if status == 304:
+                    data = self.cache.revalidate(endpoint, headers)
+                    return data
+                if status == 403:
+                    try:
+                        reason = self.forbiddenReason(response.json())
+                    except ValueError:
+                        pass
+
+            except requests.exceptions.RequestException as e:
+                print(f"An error occurred: {e}")
+            finally:
+                self.limiter.release(status)
+                observeRequest(endpoint, status, time.perf_counter() - started)
+                if self.recorder and status is not None:
+                    self.recorder.record(endpoint, status, data)
+
+            if status == 403 and retry and self.canRefresh(reason):
+                try:
+                    self.refreshToken(stale)
+                    return self.getData(endpoint, retry=False)  # Recursive Retry
+                except Exception as e:
+                    print(f"CRITICAL: Token refresh failed: {e}")
 
-            response = requests.get(URL, headers=self.headers)
+            delay = self.limiter.retryDelay(status, headers, attempt)
+            if delay is None:
+                break
+            time.sleep(delay)
 
+        print(f"Error fetching {endpoint}. Status code: {status}")
+        return None
 
-            if response.status_code == 403 and retry and self.email and self.password:
-                print(f"!! 403 Forbidden. IP changed. Refreshing Token...")
+    def getMany(self, endpoints, retry=True):
+        """
+        Fetches many endpoints concurrently (bounded by the rate limiter's window).
+        Returns {endpoint: data}, with None for anything that failed.
+        """
+        results = {}
+        for endpoint in dict.fromkeys(endpoints):
+            results[endpoint] = self.cache.lookup(endpoint)
+
+        stale = [e for e, data in results.items() if data is None]
+        if stale:
+            capture = activeCapture()  # Profiling is per thread; hand it to the loop thread explicitly
+            future = asyncio.run_coroutine_threadsafe(self.fetchAll(stale, retry, capture), self.eventLoop())
+            with span("api wait", capture):
+                results.update(future.result())
+        return results
+
+    def eventLoop(self):
+        with self.loopLock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(target=self.loop.run_forever, name="FetchLoop", daemon=True).start()
+        return self.loop
+
+    async def fetchAll(self, endpoints, retry, capture=None):
+        if self.client is None:
+            # One pooled client for the lifetime of the session
+            connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+            self.client = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+
+        results = await asyncio.gather(*(self.fetchOne(e, retry, capture) for e in endpoints))
+        return dict(zip(endpoints, results))
+
+    async def fetchOne(self, endpoint, retry=True, capture=None):
+        for attempt in range(self.limiter.retries + 1):
+            await self.limiter.acquireAsync()
+            status, headers, data, reason = None, {}, None, None
+            started = time.perf_counter()
+            try:
+                token, stale = self.credential()
+                async with self.client.get(self.url(endpoint), headers=self.requestHeaders(endpoint, token)) as response:
+                    status, headers = response.status, response.headers
+                    if status == 200:
+                        with span("json decode", capture):  # Includes reading the body
+                            data = await response.json()
+                        self.cache.store(endpoint, data, headers)
+                        return data
+                    if status == 304:
+                        data = self.cache.revalidate(endpoint, headers)
+                        return data
+                    if status == 403:
+                        try:
+                            reason = self.forbiddenReason(await response.json(content_type=None))
+                        except (ValueError, aiohttp.ClientError):
+                            pass
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"An error occurred: {e}")
+            finally:
+                self.limiter.release(status)
+                observeRequest(endpoint, status, time.perf_counter() - started)
+                if self.recorder and status is not None:
+                    self.recorder.record(endpoint, status, data)
+
+            if status == 403 and retry and self.canRefresh(reason):
                 try:
-                    from tracker import get_valid_token  # Import here to avoid circular imports
-                    new_token = get_valid_token()
-                    self.TOKEN = new_token
-                    self.headers["Authorization"] = f"Bearer {self.TOKEN}"
-                    return self.getData(endpoint, retry=False)  # Recursive Retry
+                    # Logging in runs its own asyncio loop, so keep it off this one
+                    await asyncio.get_running_loop().run_in_executor(None, self.refreshToken, stale)
+                    return await self.fetchOne(endpoint, retry=False, capture=capture)
                 except Exception as e:
                     print(f"CRITICAL: Token refresh failed: {e}")
 
-            if response.status_code == 200:
-                data = response.json()
-            else:
-                print(f"Error fetching data. Status code: {response.status_code}")
-
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred: {e}")
+            delay = self.limiter.retryDelay(status, headers, attempt)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
 
-        return data
+        print(f"Error fetching {endpoint}. Status code: {status}")
+        return None
 
     def getPlayerData(self):
         pass
@@ -91,28 +733,91 @@ class clan:
         self.name = self.data['name']
         self.clanTag = self.data['tag']
         self.level = self.data['clanLevel']
+        self.lastFetch = {}  # playerTag -> monotonic time of this clan's last fetch of them
+        self.lock = threading.Lock()  # Held by the harvester around anything that replaces players
         self.saveClanData()
 
         self.saveClanMemberData()
 
-    def saveClanData(self):
-        sql = """
-        SELECT tag FROM Clan WHERE tag = ?;
+    @staticmethod
+    def warmStart(tag, session, saved=None):
         """
-        clans = self.session.db.execute(sql,(self.clanTag,))
-        if not clans:
-            sql = """
-            INSERT IGNORE INTO Clan(tag,name,level) Values(?,?,?)
-            """
-            self.session.db.execute(sql, (self.clanTag,self.name,self.level))
+        Rebuilds a clan and its roster from a checkpoint entry, or from the DB if there is none,
+        without any API calls. Returns None for clans we have never stored.
+        """
+        if saved:
+            name, level, roster = saved['name'], saved['level'], saved['players']
+        else:
+            known = session.index.clan(tag)
+            if not known:
+                return None
+            (name, level), roster = known, session.index.roster(tag)
+
+        c = clan.__new__(clan)
+        c.session = session
+        c.data = None
+        c.name = name
+        c.clanTag = tag
+        c.level = level
+        c.lastFetch = {}
+        c.lock = threading.Lock()
+        c.players = [player.fromRoster(t, tag, n, session) for t, n in roster]
+        return c
+
+    def checkpoint(self):
+        return {"tag": self.clanTag, "name": self.name, "level": self.level,
+                "players": [[p.playerTag, p.name] for p in self.players]}
+
+    def refreshRoster(self):
+        # Reconciles a warm-started roster with the API; only players we have not seen get fetched
+        fresh = self.session.getData(f"clans/{self.clanTag}")
+        if not fresh:
+            return
+
+        self.data = fresh
+        self.name = fresh['name']
+        self.level = fresh['clanLevel']
+        self.saveClanData()
+
+        known = {p.playerTag: p for p in self.players}
+        tags = [m['tag'] for m in fresh.get('memberList', [])]
+        fetched = self.fetchPlayers([t for t in tags if t not in known])
+        for t, data in fetched.items():
+            known[t] = player(t, self.session, data=data)
+
+        self.players = [known[t] for t in tags if t in known]
+        self.session.db.flush()
+
+    def saveClanData(self):
+        self.session.index.saveClan(self.clanTag, self.name, self.level)
+
 
+    def fetchPlayers(self, tags, reuse=0):
+        """
+        {tag: payload} for these players from one getMany; failed fetches are left out.
+        With reuse > 0, players this clan fetched less than `reuse` seconds ago are skipped
+        (and not returned): that fetch already observed them.
+        """
+        now = time.monotonic()
+        if reuse:
+            tags = [t for t in tags if now - self.lastFetch.get(t, float("-inf")) >= reuse]
+
+        fetched = self.session.getMany([f"players/{t}" for t in tags])
+        result = {}
+        for t in tags:
+            data = fetched.get(f"players/{t}")
+            if data:
+                result[t] = data
+                self.lastFetch[t] = now
+        return result
 
     def saveClanMemberData(self):
-        self.players = []
-        for m in self.data['memberList']:
-            self.players.append(player(m['tag'],self.session))
+        tags = [m['tag'] for m in self.data['memberList']]
+        fetched = self.fetchPlayers(tags)
+        self.players = [player(t, self.session, data=fetched[t]) for t in tags if t in fetched]
+        self.session.db.flush()
 
-    def savePlayersSnapshot(self):  # run every half hour
+    def savePlayersSnapshot(self, time=None):  # run every hour
 
         fresh_data = self.session.getData(f"clans/{self.clanTag}")
 
@@ -125,37 +830,89 @@ class clan:
                 print(f"!! Warning: API returned 0 members for {self.name}. Skipping cleanup to be safe.")
                 return
 
-            sql_check = "SELECT playerTag FROM Player WHERE clanTag = ?"
-            db_members = self.session.db.execute(sql_check, (self.clanTag,))
-
-            db_member_tags = [row[0] for row in db_members]
+            current = set(current_member_tags)
+            db_member_tags = self.session.index.members(self.clanTag)
+            cycle_time = time or datetime.now()  # Every snapshot in this cycle shares one timestamp
 
             for db_tag in db_member_tags:
-                if db_tag not in current_member_tags:
+                if db_tag not in current:
                     print(f"-> Player {db_tag} has LEFT/KICKED. Updating DB...")
                     # Remove them from the clan in the DB so we don't track them anymore
-                    update_sql = "UPDATE Player SET clanTag = NULL WHERE playerTag = ?"
-                    self.session.db.execute(update_sql, (db_tag,))
-
+                    self.session.index.leaveClan(db_tag, self.clanTag)
+                    playerSnapshot.saveDeparture(self.session, db_tag, self.clanTag, cycle_time)
 
+            # Roster diff: members we already hold are reused, newcomers are built from the same payload.
+            # Either way each member is fetched once and snapshotted once per cycle.
+            known = {p.playerTag: p for p in self.players}
+            fetched = self.fetchPlayers(current_member_tags)
             self.players = []
-
-            for m in fresh_data.get('memberList', []):
-                p_obj = player(m['tag'], self.session)
+            for t in current_member_tags:
+                data = fetched.get(t)
+                if data is None:
+                    if t in known:
+                        self.players.append(known[t])  # Fetch failed: keep them for the next run
+                    continue
+                if t in known:
+                    p_obj = known[t]
+                    p_obj.refresh(data)
+                    p_obj.snapshot = p_obj.getNewSnapshot(getData=False, time=cycle_time)
+                else:
+                    p_obj = player(t, self.session, data=data, time=cycle_time)
                 self.players.append(p_obj)
-                p_obj.snapshot = p_obj.getNewSnapshot()
+            self.lastFetch = {t: at for t, at in self.lastFetch.items() if t in current}
+
+            # Records that every member was observed at cycle_time, even if no row was stored for them
+            self.session.db.buffer("INSERT IGNORE INTO SnapshotCycle (clanTag, time) VALUES (?, ?)",
+                                   (self.clanTag, cycle_time))
+            self.session.db.flush()  # One transaction per clan
+
+
+    def savePlayersActivity(self, time=None): # run every 5 mins
+        pending = self.players
+        if ACTIVITY_MODE == "members":
+            listing = self.session.getData(f"clans/{self.clanTag}/members")
+            if listing:
+                # One request for the whole clan. Newcomers are left to the snapshot job, which adds them
+                known = {p.playerTag: p for p in self.players}
+                pending = []
+                for m in listing.get('items', []):
+                    p = known.get(m['tag'])
+                    if p is None:
+                        continue
+                    if all(f in m for f in ACTIVITY_FIELDS):
+                        p.observe(m, time)
+                    else:
+                        pending.append(p)
+
+        # Members the snapshot job fetched moments ago were observed by it; no point asking again
+        fetched = self.fetchPlayers([p.playerTag for p in pending], reuse=PLAYER_REUSE_SECONDS)
+        for p in pending:
+            data = fetched.get(p.playerTag)
+            if data:
+                p.activityCheck(data, time)
+        self.session.db.flush()
 
 
-    def savePlayersActivity(self): # run every 10 mins
-        for p in self.players:
-            p.activityCheck()
+def fix_time(t):
+    if not t: return None
+    try:
+        # Parse the "YYYYMMDDTHHMMSS.000Z" format
+        return datetime.strptime(t, "%Y%m%dT%H%M%S.%fZ")
+    except ValueError:
+        return None
 
 
-class clanWar: # run every 30 mins
+class clanWar: # run every 10 mins
 
-    def __init__(self,session,tag):
+    """
+    Single-pass ingestion of one clans/{tag}/currentwar payload. ClanWar, WarPlayer, Attack and
+    (once the war has ended) WarResults are all written in one transaction, resolving warID once.
+    """
+
+    def __init__(self,session,tag,data=None,time=None):
         self.session = session
-        self.data = session.getData(f"clans/{tag}/currentwar")
+        self.seenTime = time  # When the payload was fetched (replay); new attacks are stamped with it
+        self.data = data if data is not None else session.getData(f"clans/{tag}/currentwar")
 
         # 1. Check State First
 
@@ -172,146 +929,189 @@ class clanWar: # run every 30 mins
         self.clanTag1 = tag
         self.clanTag2 = self.data['opponent']['tag']
 
-        # If clanTag1 failed to load earlier, this saves it now so the War doesn't crash.
-        check_sql = "SELECT tag FROM Clan WHERE tag = ?"
-        if not self.session.db.execute(check_sql, (self.clanTag1,)):
-
-            my_name = self.data['clan']['name']
-            my_level = self.data['clan']['clanLevel']
-            insert_sql = "INSERT IGNORE INTO Clan(tag, name, level) VALUES(?, ?, ?)"
-            self.session.db.execute(insert_sql, (self.clanTag1, my_name, my_level))
-
-
-        opp_name = self.data['opponent']['name']
-        opp_level = self.data['opponent']['clanLevel']
-        check_sql = "SELECT tag FROM Clan WHERE tag = ?"
-        if not self.session.db.execute(check_sql, (self.clanTag2,)):
-            insert_sql = "INSERT IGNORE INTO Clan(tag, name, level) VALUES(?, ?, ?)"
-            self.session.db.execute(insert_sql, (self.clanTag2, opp_name, opp_level))
-
-
         self.teamSize = self.data['teamSize']
-        self.startTime = self.data['startTime']
-        self.endTime = self.data['endTime']
+        self.startTime = fix_time(self.data.get('startTime'))
+        self.endTime = fix_time(self.data.get('endTime'))
         self.warType = "Standard"
         self.leagueGroupID = None
         self.league = None
         self.id = None;
+        self.newAttacks = []
+        self.newWar = False
 
-        self.saveWar()
-        for m in self.data['opponent']['members']:
-            player = warPlayer(m,self.clanTag2)
-            player.savePlayer(self.session,self)
-
-        for m in self.data['clan']['members']:
-            player = warPlayer(m,self.clanTag1)
-            player.savePlayer(self.session, self)
+        if not self.startTime:
+            print(f"!! War for {tag} has no usable startTime. Skipping.")
+            return
 
+        # If clanTag1 failed to load earlier, this saves it now so the War doesn't crash.
+        for side, side_tag in (('clan', self.clanTag1), ('opponent', self.clanTag2)):
+            self.session.index.saveClan(side_tag, self.data[side]['name'], self.data[side]['clanLevel'])
 
-    def saveWar(self):
-        def fix_time(t):
-            if not t: return None
-            try:
-                # Parse the "YYYYMMDDTHHMMSS.000Z" format
-                dt = datetime.strptime(t, "%Y%m%dT%H%M%S.%fZ")
-                return dt
-            except ValueError:
-                return None
+        try:
+            with self.session.db.transaction() as tx:
+                if self.saveWar(tx):
+                    self.saveWarPlayers(tx)
+                    self.saveAttacks(tx)
+                    if self.state == 'warEnded':
+                        self.saveResults(tx)
+            self.session.index.commitWar(self.id, self.newAttacks, ended=self.state == 'warEnded')
+        except Exception as e:
+            print(f"!! War ingestion failed for {tag}: {e}")
 
+    @staticmethod
+    def ingestAll(session, clan_tags):
+        wars = session.getMany([f"clans/{t}/currentwar" for t in clan_tags])
+        for tag in clan_tags:
+            data = wars.get(f"clans/{tag}/currentwar")
+            if data:
+                clanWar(session, tag, data)
+
+    def saveWar(self, tx):
+        """Upserts the ClanWar row and sets self.id. Returns False if the war is already fully stored."""
+        # Either side may have recorded the war first, so match both orientations.
+        # FOR UPDATE: polls of the same war (both sides tracked, or another worker) take turns, so the
+        # attack keys read under this lock are exactly what is stored
         sql = """
-                SELECT warID FROM ClanWar 
+                SELECT warID, state FROM ClanWar 
                 WHERE ((clanTag1 = ? AND clanTag2 = ?) OR (clanTag1 = ? AND clanTag2 = ?))
-                AND state IN ('preparation', 'inWar');
+                AND startTime = ? FOR UPDATE;
                 """
-
-        # Pass the tags twice to cover both (A, B) and (B, A) cases
-        wars = self.session.db.execute(sql, (self.clanTag1, self.clanTag2, self.clanTag2, self.clanTag1))
+        wars = tx.execute(sql, (self.clanTag1, self.clanTag2, self.clanTag2, self.clanTag1, self.startTime))
 
         if not wars:
             sql = """
-            INSERT IGNORE INTO ClanWar(clanTag1,clanTag2,state,teamSize,startTime,endTime,warType,leagueGroupId,league) Values(?,?,?,?,?,?,?,?,?)
+            INSERT INTO ClanWar(clanTag1,clanTag2,state,teamSize,startTime,endTime,warType,leagueGroupId,league) Values(?,?,?,?,?,?,?,?,?)
             """
+            self.id = tx.execute(sql, (self.clanTag1, self.clanTag2, self.state, self.teamSize, self.startTime,
+                                       self.endTime, self.warType, self.leagueGroupID, self.league))
+            self.newWar = True  # Nothing stored for it yet, so no attack lookup needed
+            return True
+
+        self.id = wars[0][0]
+        if wars[0][1] == 'warEnded':
+            return False  # Ended wars were ingested completely in the pass that saw them end
+
+        if wars[0][1] != self.state:
+            update_sql = "UPDATE ClanWar SET state = ?, endTime = ? WHERE warID = ?"
+            tx.execute(update_sql, (self.state, self.endTime, self.id))
+        return True
+
+    def members(self):
+        for side, tag in (('clan', self.clanTag1), ('opponent', self.clanTag2)):
+            for m in self.data[side].get('members', []):
+                yield m, tag
+
+    def saveWarPlayers(self, tx):
+        if self.session.index.hasRoster(self.id):
+            return  # Rosters are fixed once the war is announced
+        sql = """
+        INSERT IGNORE INTO WarPlayer (warID,playerTag,mapPosition,townHallLevel,name,clanTag) VALUES (?,?,?,?,?,?)
+        """
+        tx.executemany(sql, [warPlayer(m, tag).row(self.id) for m, tag in self.members()])
 
-            self.session.db.execute(sql, (self.clanTag1, self.clanTag2, self.state, self.teamSize, fix_time(self.startTime),
-                                          fix_time(self.endTime), self.warType, self.leagueGroupID, self.league))
-            id = self.session.db.execute("SELECT LAST_INSERT_ID();")
-            self.id = id[0][0]
+    def saveAttacks(self, tx):
+        if self.state not in ('inWar', 'warEnded'):
+            return
 
-        else:
-            self.id = wars[0][0]
-            update_sql = "UPDATE ClanWar SET state = ? WHERE warID = ?"
-            self.session.db.execute(update_sql, (self.state, self.id))
+        # Loaded once per war and kept across polls, so a poll with nothing new costs no query
+        stored = frozenset() if self.newWar else self.session.index.attackKeys(self.id, tx)
+
+        town_halls = {m['tag']: m['townhallLevel'] for m, _ in self.members()}
+        now = self.seenTime or datetime.now()
+        rows = []
+        stats = []
+        for m, tag in self.members():
+            for atk in m.get('attacks', []):
+                key = (atk['attackerTag'], atk['defenderTag'])
+                if key not in stored:
+                    self.newAttacks.append(key)
+                    rows.append((self.id, key[0], key[1], atk['stars'],
+                                 atk['destructionPercentage'], now, atk['duration']))
+                    if key[1] in town_halls:
+                        stats.append((key[0], tag, m['townhallLevel'], town_halls[key[1]],
+                                      atk['stars'], atk['destructionPercentage']))
+
+        insert_sql = """
+        INSERT IGNORE INTO Attack (warID, attackerTag, defenderTag, stars, destruction, startTime, duration)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """
+        tx.executemany(insert_sql, rows)
+        if tx.rowcount != len(rows) and rows:
+            # INSERT IGNORE skipped some, which the row lock should rule out. Roll back rather than count
+            # them in the leaderboards twice (or cache them as ours); the next poll re-reads the keys.
+            raise RuntimeError(f"{len(rows) - tx.rowcount} of {len(rows)} new attacks were already stored")
+        recordAttacks(tx, self.startTime, stats)  # Same transaction: leaderboards move with the Attack rows
+
+    def saveResults(self, tx):
+        # Same totals checkWarEnded derives from the Attack table: star sum and mean destruction per attack
+        totals = {self.clanTag1: [0, 0.0, 0], self.clanTag2: [0, 0.0, 0]}
+        for m, tag in self.members():
+            for atk in m.get('attacks', []):
+                totals[tag][0] += atk['stars']
+                totals[tag][1] += atk['destructionPercentage']
+                totals[tag][2] += 1
+
+        tx.executemany(warResults.insert_sql, warResults.rows(
+            self.id,
+            (self.clanTag1, totals[self.clanTag1][0], warResults.average(totals[self.clanTag1])),
+            (self.clanTag2, totals[self.clanTag2][0], warResults.average(totals[self.clanTag2]))))
+
+
+class warResults: # run every 5 minutes, catches wars whose warEnded payload was never polled
+
+    insert_sql = """
+            INSERT  IGNORE INTO WarResults (warID, clanTag, totalDestruction, totalStars, result)
+            VALUES (?, ?, ?, ?, ?)
+            """
 
+    @staticmethod
+    def average(total):
+        stars, destruction, attacks = total
+        return destruction / attacks if attacks > 0 else 0
 
+    @staticmethod
+    def rows(warID, side1, side2):
+        """side = (clanTag, stars, destruction). Stars decide, destruction breaks ties."""
+        if (side1[1], side1[2]) > (side2[1], side2[2]):
+            states = ("WIN", "LOSS")
+        elif (side1[1], side1[2]) < (side2[1], side2[2]):
+            states = ("LOSS", "WIN")
+        else:
+            states = ("DRAW", "DRAW")
 
-class warResults: # run every 5 minutes
+        return [(warID, side1[0], side1[2], side1[1], states[0]),
+                (warID, side2[0], side2[2], side2[1], states[1])]
 
     @staticmethod
     def checkWarEnded(session):
+        # Anti-join keeps this to ended wars that still lack results, however long the history gets.
+        # One grouped aggregate returns both sides' totals for every pending war.
+        # Attacks by anyone not in clanTag1 count for the opponent; attackers missing from the roster are ignored.
         sql = """
-        SELECT warID,clanTag1,clanTag2 FROM ClanWar WHERE state = "warEnded";
+        SELECT cw.warID, cw.clanTag1, cw.clanTag2,
+            SUM(CASE WHEN p.clanTag = cw.clanTag1 THEN a.stars ELSE 0 END),
+            AVG(CASE WHEN p.clanTag = cw.clanTag1 THEN a.destruction END),
+            SUM(CASE WHEN p.clanTag <> cw.clanTag1 THEN a.stars ELSE 0 END),
+            AVG(CASE WHEN p.clanTag <> cw.clanTag1 THEN a.destruction END)
+        FROM ClanWar cw
+        LEFT JOIN WarResults wr ON wr.warID = cw.warID
+        LEFT JOIN Attack a ON a.warID = cw.warID
+        LEFT JOIN WarPlayer p ON p.playerTag = a.attackerTag AND p.warID = a.warID
+        WHERE cw.state = 'warEnded' AND wr.warID IS NULL
+        GROUP BY cw.warID, cw.clanTag1, cw.clanTag2;
         """
         wars = session.db.execute(sql)
 
-        if wars:
-            for war in wars:
-                check_sql = "SELECT 1 FROM WarResults WHERE warID = ?"
-                exists = session.db.execute(check_sql, (war[0],))
-
-                if not exists:
-                    sql = """
-                    SELECT a.stars, a.destruction, p.clanTag 
-                    FROM Attack a
-                    JOIN WarPlayer p ON a.attackerTag = p.playerTag AND a.warID = p.warID
-                    WHERE a.warID = ?
-                    """
-                    attacks = session.db.execute(sql,(war[0],))
-                    stars = [0,0]
-                    destruction = [0,0]
-                    numOfAttacks = [0,0]
-
-                    for attack in attacks:
-                        if attack[2] == war[1]:
-                            stars[0] += attack[0]
-                            destruction[0] += attack[1]
-                            numOfAttacks[0] +=1
-                        else:
-                            stars[1] += attack[0]
-                            destruction[1] += attack[1]
-                            numOfAttacks[1] +=1
-
-                    if numOfAttacks[0] > 0:
-                        destruction[0] /= numOfAttacks[0]
-                    if numOfAttacks[1] > 0:
-                        destruction[1] /= numOfAttacks[1]
-
-                    sql = """
-                            INSERT  IGNORE INTO WarResults (warID, clanTag, totalDestruction, totalStars, result)
-                            VALUES (?, ?, ?, ?, ?)
-                            """
-                    states = [None,None]
-                    if stars[0] > stars[1]:
-                        states[0] = "WIN"
-                        states[1] = "LOSS"
-
-                    elif stars[0] < stars[1]:
-                        states[0] = "LOSS"
-                        states[1] = "WIN"
-
-                    elif destruction[0] > destruction[1]:
-                        states[0] = "WIN"
-                        states[1] = "LOSS"
-
-                    elif destruction[0] < destruction[1]:
-                        states[0] = "LOSS"
-                        states[1] = "WIN"
-                    else:
-                        states[0] = "DRAW"
-                        states[1] = "DRAW"
+        if not wars:
+            return
 
+        rows = []
+        for warID, clanTag1, clanTag2, stars1, destruction1, stars2, destruction2 in wars:
+            rows += warResults.rows(warID,
+                                    (clanTag1, stars1 or 0, destruction1 or 0),
+                                    (clanTag2, stars2 or 0, destruction2 or 0))
 
-                    session.db.execute(sql,(war[0],war[1],destruction[0],stars[0],states[0]))
-                    session.db.execute(sql, (war[0], war[2], destruction[1], stars[1], states[1]))
+        session.db.executemany(warResults.insert_sql, rows)  # One batch, one transaction
 
 class warPlayer:
     def __init__(self,data,clanTag):
@@ -321,150 +1121,95 @@ class warPlayer:
         self.name = data['name']
         self.clanTag = clanTag
 
-    def savePlayer(self,session,war):
-        sql = """
-        INSERT IGNORE INTO WarPlayer (warID,playerTag,mapPosition,townHallLevel,name,clanTag) VALUES (?,?,?,?,?,?)
-        """
-        session.db.execute(sql,(war.id, self.playerTag,self.mapPosition,self.townHallLevel,self.name,self.clanTag,))
+    def row(self, warID):
+        return (warID, self.playerTag, self.mapPosition, self.townHallLevel, self.name, self.clanTag)
 
 
 class attack:  # run every 10 minutes
 
     @staticmethod
-    def saveAttacks(session):
-
-        clans = session.db.execute("SELECT tag FROM Clan;")
-
-        if not clans:
-            return
-
-        for clan_row in clans:
-            clan_tag = clan_row[0]
-
-
-            data = session.getData(f"clans/{clan_tag}/currentwar")
-
-            if not data or data.get('state') not in ['inWar', 'warEnded']:
-                continue
-
-
-            opponent_tag = data['opponent']['tag']
-            start_time_str = data['startTime']
-
-            try:
-                war_start_dt = datetime.strptime(start_time_str, "%Y%m%dT%H%M%S.%fZ")
-            except ValueError:
-                continue  # Skip if time format is weird
-
-
-            sql_find_war = """
-            SELECT warID FROM ClanWar 
-            WHERE clanTag1 = ? AND clanTag2 = ? AND startTime = ?
-            """
-
-            war_id_row = session.db.execute(sql_find_war, (clan_tag, opponent_tag, war_start_dt))
-
-            if not war_id_row:
-
-                war_id_row = session.db.execute(sql_find_war, (opponent_tag, clan_tag, war_start_dt))
-
-            if not war_id_row:
-
-                continue
-
-            current_war_id = war_id_row[0][0]
-
-
-            def process_member_attacks(members):
-                for m in members:
-                    for atk in m.get('attacks', []):
-                        attacker_tag = atk['attackerTag']
-                        defender_tag = atk['defenderTag']
-
-
-                        check_sql = "SELECT 1 FROM Attack WHERE warID=? AND attackerTag=? AND defenderTag=?"
-                        exists = session.db.execute(check_sql, (current_war_id, attacker_tag, defender_tag))
-
-                        if not exists:
-
-                            insert_sql = """
-                            INSERT IGNORE INTO Attack (warID, attackerTag, defenderTag, stars, destruction, startTime, duration)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                            """
-                            session.db.execute(insert_sql, (
-                                current_war_id,
-                                attacker_tag,
-                                defender_tag,
-                                atk['stars'],
-                                atk['destructionPercentage'],
-                                datetime.now(),
-                                atk['duration']
-                            ))
-
+    def saveAttacks(session, clan_tags=None):
+        # Attacks are ingested together with the rest of the war; see clanWar
+        if clan_tags is None:
+            clans = session.db.execute("SELECT tag FROM Clan;")
+            if not clans:
+                return
+            clan_tags = [row[0] for row in clans]
 
-            process_member_attacks(data.get('clan', {}).get('members', []))
-            process_member_attacks(data.get('opponent', {}).get('members', []))
+        clanWar.ingestAll(session, clan_tags)
 
 
 class player:
 
-    def __init__(self,tag,session):
+    activity_sql = "INSERT IGNORE INTO ActivitySnapshot (playerTag, time) VALUES (?, ?)"
+
+    def __init__(self,tag,session,data=None,time=None):
         self.session = session
-        self.data = session.getData(f"players/{tag}")
+        self.data = data if data is not None else session.getData(f"players/{tag}")
         self.playerTag = self.data['tag']
         self.clanTag = self.data['clan']['tag']
         self.name = self.data['name']
 
         self.savePlayer()
-        self.snapshot = self.getNewSnapshot(getData = False)
+        self.snapshot = self.getNewSnapshot(getData = False, time=time)
 
-    def getNewSnapshot(self,getData = True):
+    @staticmethod
+    def fromRoster(tag, clanTag, name, session):
+        # Stored player, no fetch: data is filled in by the next activity/snapshot run
+        p = player.__new__(player)
+        p.session = session
+        p.data = None
+        p.playerTag = tag
+        p.clanTag = clanTag
+        p.name = name
+        p.snapshot = None
+        return p
+
+    def refresh(self, data):
+        # New payload for a player object we keep: Player row follows name/clan changes, no refetch
+        self.data = data
+        self.name = data['name']
+        self.clanTag = data['clan']['tag'] if data.get('clan') else None
+        self.savePlayer()
+
+    def getNewSnapshot(self,getData = True, time=None):
         if getData:
             self.data = self.session.getData(f"players/{self.playerTag}")
-        snap = playerSnapshot(self)
-        snap.saveSnapshot(self.session.db)
+        snap = playerSnapshot(self, time)
+        snap.saveSnapshot(self.session.db, self.session.states)
+        self.activityCheck(self.data, time)  # A snapshot is an observation too
         return snap
 
-    def activityCheck(self):
-        self.data = self.session.getData(f"players/{self.playerTag}")
-
-        sql = """
-        SELECT builderBaseTrophies, donations, donationsRecieved FROM PlayerSnapshot WHERE playerTag = ? ORDER BY time DESC LIMIT 1;
-        """
-        result = self.session.db.execute(sql,(self.playerTag,))
-        if result:
-            data = result[0]
-
-            if (data[0] != self.data['builderBaseTrophies'] or
-                    data[1] < self.data['donations'] or
-                    data[2] < self.data['donationsReceived']):
+    def activityCheck(self, data=None, time=None):
+        self.data = data if data is not None else self.session.getData(f"players/{self.playerTag}")
+        if not self.data:
+            return
+        self.observe(self.data, time)
 
-                sql = "INSERT IGNORE INTO ActivitySnapshot (playerTag, time) VALUES (?, ?)"
-                self.session.db.execute(sql, (self.playerTag, datetime.now()))
+    def observe(self, data, time=None):
+        # Any payload with the activity fields (player or members-list entry); self.data is left alone
+        # Compared against the last observed state, not the last hourly snapshot
+        if self.session.states.observe(self.playerTag, data):
+            self.session.db.buffer(self.activity_sql, (self.playerTag, time or datetime.now()))
 
     def savePlayer(self):
 
-        if self.clanTag:
-            check_clan_sql = "SELECT 1 FROM Clan WHERE tag = ?"
-            if not self.session.db.execute(check_clan_sql, (self.clanTag,)):
-                self.clanTag = None  # Unlink from unknown clan
+        if self.clanTag and not self.session.index.hasClan(self.clanTag):
+            self.clanTag = None  # Unlink from unknown clan
 
+        # Inserts new players, handles returning players or name changes, skips everyone else
+        self.session.index.savePlayer(self.playerTag, self.clanTag, self.name)
 
-        # Check if player is already saved
-        sql = "SELECT playerTag FROM Player WHERE playerTag = ?;"
-        names = self.session.db.execute(sql, (self.playerTag,))
+class playerSnapshot:
 
-        if not names:
-            sql = "INSERT IGNORE INTO Player(playerTag, clanTag, name) Values(?, ?, ?)"
-            self.session.db.execute(sql, (self.playerTag, self.clanTag, self.name))
-        else:
-            # Handle returning players or name changes
-            sql = "UPDATE Player SET clanTag = ?, name = ? WHERE playerTag = ?"
-            self.session.db.execute(sql, (self.clanTag, self.name, self.playerTag))
+    insert_sql = f"""
+        INSERT IGNORE INTO PlayerSnapshot 
+        (playerTag,time,{",".join(SNAPSHOT_COLUMNS)})
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);
 
-class playerSnapshot:
+        """
 
-    def __init__(self,player):
+    def __init__(self,player,time=None):
         self.clanTag = player.clanTag
         self.playerTag = player.playerTag
 
@@ -489,16 +1234,65 @@ class playerSnapshot:
         else:
             self.league = 'Unranked'
 
-        self.time = datetime.now()
-    def saveSnapshot(self,db):
-        sql = """
-        INSERT IGNORE INTO PlayerSnapshot 
-        (playerTag,time,clanTag,townHallLevel,exLevel,warStars,builderHallLevel,builderBaseTrophies,role,warPreference,donations,donationsRecieved,clanCapitalContributions,league)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?);
+        self.time = time or datetime.now()
 
-        """
+    def fields(self):
+        return (self.clanTag,self.townHallLevel,self.exLevel,self.warStars,self.builderHallLevel,self.builderBaseTrophies,
+                self.role,self.warPreference,self.donations,self.donationsReceived,self.clanCapitalContributions,self.league)
 
-        db.execute(sql,(self.playerTag,self.time,self.clanTag,self.townHallLevel,self.exLevel,self.warStars,self.builderHallLevel,self.builderBaseTrophies,self.role,self.warPreference,self.donations,self.donationsReceived,self.clanCapitalContributions,self.league))
+    def saveSnapshot(self,db,states=None):
+        # Delta mode: unchanged players are covered by the clan's SnapshotCycle row instead
+        if SNAPSHOT_MODE == "delta" and states is not None and not states.snapshotChanged(self.playerTag, self.fields()):
+            return
 
+        db.buffer(self.insert_sql,(self.playerTag,self.time) + self.fields())
 
+    @staticmethod
+    def saveDeparture(session, playerTag, clanTag, time):
+        # Ends the player's carried-forward state for history()
+        session.states.forgetSnapshot(playerTag)
+        session.db.buffer("INSERT IGNORE INTO PlayerDeparture (playerTag, clanTag, time) VALUES (?, ?, ?)",
+                          (playerTag, clanTag, time))
 
+    @staticmethod
+    def history(db, playerTag, start, end):
+        """
+        Full snapshot series for one player between start and end, as dicts, in either storage mode.
+        Stored rows are observations; so is every SnapshotCycle of the clan the player was in
+        at the time, which in delta mode stands for the unchanged rows that weren't written.
+        A PlayerDeparture ends that until the player's next stored row.
+        """
+        columns = ", ".join(["time"] + SNAPSHOT_COLUMNS)
+        before = db.execute(f"SELECT {columns} FROM PlayerSnapshot WHERE playerTag = ? AND time < ? "
+                            f"ORDER BY time DESC LIMIT 1", (playerTag, start)) or []
+        rows = db.execute(f"SELECT {columns} FROM PlayerSnapshot WHERE playerTag = ? AND time BETWEEN ? AND ? "
+                          f"ORDER BY time", (playerTag, start, end)) or []
+        departed = db.execute("SELECT time FROM PlayerDeparture WHERE playerTag = ? AND time < ? "
+                              "ORDER BY time DESC LIMIT 1", (playerTag, start)) or []
+        departures = db.execute("SELECT time FROM PlayerDeparture WHERE playerTag = ? AND time BETWEEN ? AND ?",
+                                (playerTag, start, end)) or []
+
+        clans = list({row[1] for row in before + rows if row[1] is not None})
+        cycles = []
+        if clans:
+            cycles = db.execute(f"SELECT time, clanTag FROM SnapshotCycle WHERE time BETWEEN ? AND ? "
+                                f"AND clanTag IN ({','.join('?' * len(clans))}) ORDER BY time",
+                                (start, end, *clans)) or []
+
+        # Merge by time; at equal times stored rows come first, then departures, then cycles
+        events = sorted([(row[0], 0, row) for row in rows] + [(d[0], 1, d) for d in departures] +
+                        [(c[0], 2, c) for c in cycles], key=lambda e: (e[0], e[1]))
+        state = before[0] if before else None
+        if state and departed and departed[0][0] >= state[0]:
+            state = None  # Left before the range started
+        series = []
+        for time, kind, event in events:
+            if kind == 1:
+                state = None
+                continue
+            if kind == 0:
+                state = event
+            elif state is None or state[1] != event[1] or (series and series[-1]["time"] == time):
+                continue
+            series.append(dict(zip(["time"] + SNAPSHOT_COLUMNS, (time,) + tuple(state[1:]))))
+        return series
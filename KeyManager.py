@@ -0,0 +1,107 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+from datetime import datetime
+import dotenv
+
+
+class KeyManager:
+    """
+    Logs into the developer portal once and holds several API keys for the current IP.
+    Keys are cached on disk so restarts don't log in again, and handed out round-robin.
+    When a key is rejected (403), every thread that saw it shares one re-login, and next()
+    keeps handing out the old keys while it runs.
+    """
+
+    def __init__(self, email=None, password=None, key_count=None, cache_file=None):
+        dotenv.load_dotenv()
+        self.email = email or os.environ.get("COC_EMAIL")
+        self.password = password or os.environ.get("COC_PASSWORD")
+        self.key_count = key_count or int(os.environ.get("COC_KEY_COUNT", 3))
+        self.cache_file = cache_file or os.environ.get("KEY_CACHE_FILE", "api_keys.json")
+
+        self.lock = threading.Lock()
+        self.keys = []
+        self.cycle = None
+        self.generation = 0
+        self.refreshing = None  # Event set when the running re-login finishes
+
+    def load(self):
+        keys = self.readCache()
+        if keys:
+            print(f"Loaded {len(keys)} API keys from {self.cache_file}.")
+        else:
+            keys = self.login()
+            self.writeCache(keys)
+        self.setKeys(keys)
+        return self
+
+    def setKeys(self, keys):
+        self.keys = list(keys)
+        self.cycle = itertools.cycle(self.keys)
+        self.generation += 1
+
+    def next(self):
+        """Returns (key, generation); pass the generation back to refresh() on a 403."""
+        with self.lock:
+            return next(self.cycle), self.generation
+
+    def refresh(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return  # Another thread already replaced the keys this request was using
+            done = self.refreshing
+            if done is None:
+                done = self.refreshing = threading.Event()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            done.wait()  # Someone else is logging in for this generation
+            return
+
+        # Logged in outside the lock: next() runs on the fetch loop and must never wait on the portal
+        try:
+            print(f"!! 403 Forbidden. IP changed. Refreshing {self.key_count} API keys...")
+            keys = self.login()
+            self.writeCache(keys)
+            with self.lock:
+                self.setKeys(keys)
+        finally:
+            with self.lock:
+                self.refreshing = None
+            done.set()
+
+    def login(self):
+        # Helper for asyncio loop
+        async def fetch():
+            import coc
+            async with coc.Client(key_count=self.key_count) as client:
+                await client.login(self.email, self.password)
+                http = client.http
+                if hasattr(http, 'keys'):
+                    # http.keys cycles endlessly; take one lap
+                    keys = list(dict.fromkeys(itertools.islice(iter(http.keys), self.key_count)))
+                    if keys:
+                        return keys
+                raise Exception("No API keys found.")
+
+        return asyncio.run(fetch())
+
+    def readCache(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)["keys"]
+        except (OSError, ValueError, KeyError):
+            return []
+
+    def writeCache(self, keys):
+        try:
+            # Keys are secrets: owner-only permissions
+            fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                json.dump({"savedAt": datetime.now().isoformat(), "keys": keys}, f)
+        except OSError as e:
+            print(f"!! Could not cache API keys: {e}")
@@ -0,0 +1,146 @@
+import os
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+from DBManager import DBManager
+
+
+# Attacker TH minus defender TH, clamped: -3 means three or more levels down, 3 three or more up
+TH_DIFF_LIMIT = 3
+
+# Running sums per key; averages and rates are derived when reading
+STAT_COLUMNS = "attacks, stars, destruction, threeStars"
+UPSERT = "attacks = attacks + VALUES(attacks), stars = stars + VALUES(stars), " \
+         "destruction = destruction + VALUES(destruction), threeStars = threeStars + VALUES(threeStars)"
+
+PLAYER_SQL = f"""
+    INSERT INTO PlayerWarStats (season, playerTag, thDiff, {STAT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON DUPLICATE KEY UPDATE {UPSERT}
+    """
+CLAN_SQL = f"""
+    INSERT INTO ClanWarStats (season, clanTag, thDiff, {STAT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON DUPLICATE KEY UPDATE {UPSERT}
+    """
+MATCHUP_SQL = f"""
+    INSERT INTO THMatchupStats (attackerTH, defenderTH, {STAT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)
+    ON DUPLICATE KEY UPDATE {UPSERT}
+    """
+
+
+def season(t):
+    # Calendar month of the war's start; close enough to the game's season for rankings
+    return t.strftime("%Y-%m")
+
+
+def thDiff(attackerTH, defenderTH):
+    return max(-TH_DIFF_LIMIT, min(TH_DIFF_LIMIT, attackerTH - defenderTH))
+
+
+def recordAttacks(tx, warStart, attacks):
+    """
+    Adds newly inserted attacks to the leaderboard tables, inside the ingesting transaction so the
+    stats commit (or roll back) with the Attack rows.
+    attacks = [(attackerTag, attackerClan, attackerTH, defenderTH, stars, destruction), ...]
+    """
+    if not attacks:
+        return
+
+    players, clans, matchups = {}, {}, {}
+    month = season(warStart)
+    for attackerTag, clanTag, attackerTH, defenderTH, stars, destruction in attacks:
+        diff = thDiff(attackerTH, defenderTH)
+        for totals, key in ((players, (month, attackerTag, diff)), (clans, (month, clanTag, diff)),
+                            (matchups, (attackerTH, defenderTH))):
+            row = totals.setdefault(key, [0, 0, 0.0, 0])
+            row[0] += 1
+            row[1] += stars
+            row[2] += destruction
+            row[3] += stars == 3
+
+    tx.executemany(PLAYER_SQL, [key + tuple(v) for key, v in players.items()])
+    tx.executemany(CLAN_SQL, [key + tuple(v) for key, v in clans.items()])
+    tx.executemany(MATCHUP_SQL, [key + tuple(v) for key, v in matchups.items()])
+
+
+def rebuild(db):
+    """
+    Recomputes all three tables from Attack x WarPlayer x ClanWar (backfill, or after drift).
+    Ingestion that commits while this runs can be counted twice or missed, so run it while the
+    harvesters are stopped.
+    """
+    diff = f"GREATEST(-{TH_DIFF_LIMIT}, LEAST({TH_DIFF_LIMIT}, att.townHallLevel - def.townHallLevel))"
+    stats = "COUNT(*), SUM(a.stars), SUM(a.destruction), SUM(a.stars = 3)"
+    source = """
+        FROM Attack a
+        JOIN WarPlayer att ON att.warID = a.warID AND att.playerTag = a.attackerTag
+        JOIN WarPlayer def ON def.warID = a.warID AND def.playerTag = a.defenderTag
+        JOIN ClanWar cw ON cw.warID = a.warID
+        """
+    with db.transaction() as tx:
+        for table in ("PlayerWarStats", "ClanWarStats", "THMatchupStats"):
+            tx.execute(f"DELETE FROM {table}")
+        tx.execute(f"""
+            INSERT INTO PlayerWarStats (season, playerTag, thDiff, {STAT_COLUMNS})
+            SELECT DATE_FORMAT(cw.startTime, '%Y-%m') AS s, a.attackerTag, {diff} AS d, {stats}
+            {source} GROUP BY s, a.attackerTag, d
+            """)
+        tx.execute(f"""
+            INSERT INTO ClanWarStats (season, clanTag, thDiff, {STAT_COLUMNS})
+            SELECT DATE_FORMAT(cw.startTime, '%Y-%m') AS s, att.clanTag, {diff} AS d, {stats}
+            {source} GROUP BY s, att.clanTag, d
+            """)
+        tx.execute(f"""
+            INSERT INTO THMatchupStats (attackerTH, defenderTH, {STAT_COLUMNS})
+            SELECT att.townHallLevel, def.townHallLevel, {stats}
+            {source} GROUP BY att.townHallLevel, def.townHallLevel
+            """)
+
+
+def topHitters(db, month, limit=20, min_attacks=4, diff=None):
+    """Tracked players for one season, best average stars first. diff limits it to one TH-differential."""
+    where, params = ("AND s.thDiff = ?", (month, diff)) if diff is not None else ("", (month,))
+    return db.execute(f"""
+        SELECT s.playerTag, p.name, SUM(s.attacks) AS n, SUM(s.stars) / SUM(s.attacks) AS avgStars,
+               SUM(s.destruction) / SUM(s.attacks), SUM(s.threeStars) / SUM(s.attacks)
+        FROM PlayerWarStats s
+        JOIN Player p ON p.playerTag = s.playerTag
+        WHERE s.season = ? {where}
+        GROUP BY s.playerTag, p.name
+        HAVING n >= ?
+        ORDER BY avgStars DESC, n DESC
+        LIMIT ?
+        """, params + (min_attacks, limit)) or []
+
+
+def clanTable(db, month):
+    """(clanTag, thDiff, attacks, avg stars, avg destruction, three-star rate) for one season."""
+    return db.execute("""
+        SELECT clanTag, thDiff, attacks, stars / attacks, destruction / attacks, threeStars / attacks
+        FROM ClanWarStats WHERE season = ? ORDER BY clanTag, thDiff
+        """, (month,)) or []
+
+
+def thMatchups(db, attackerTH=None):
+    """All-time (attackerTH, defenderTH, attacks, avg stars, avg destruction, three-star rate)."""
+    where, params = ("WHERE attackerTH = ?", (attackerTH,)) if attackerTH is not None else ("", ())
+    return db.execute(f"""
+        SELECT attackerTH, defenderTH, attacks, stars / attacks, destruction / attacks, threeStars / attacks
+        FROM THMatchupStats {where} ORDER BY attackerTH, defenderTH
+        """, params) or []
+
+
+if __name__ == "__main__":
+    # python Leaderboard.py --rebuild | python Leaderboard.py [YYYY-MM]
+    load_dotenv()
+    db = DBManager(os.environ.get("DB_HOST"), os.environ.get("DB_USER"),
+                   os.environ.get("DB_PASSWORD"), os.environ.get("DB_NAME"))
+
+    if "--rebuild" in sys.argv:
+        rebuild(db)
+        print("Leaderboards rebuilt.")
+        sys.exit(0)
+
+    month = sys.argv[1] if len(sys.argv) > 1 else season(datetime.now())
+    print(f"--- Best hitters {month} ---")
+    for tag, name, attacks, stars, destruction, triples in topHitters(db, month):
+        print(f"{name:<16} {tag:<12} {attacks:>4} attacks  {stars:.2f}★  {destruction:.1f}%  {triples:.0%} triples")
@@ -0,0 +1,167 @@
+import re
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> total
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{labelText(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = sorted(buckets)
+        self.lock = threading.Lock()
+        self.values = {}  # label values -> [count per bucket..., sum, count]
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{labelText(self.labels + ('le',), labels + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_bucket{labelText(self.labels + ('le',), labels + ('+Inf',))} {series[-1]}")
+                lines.append(f"{self.name}_sum{labelText(self.labels, labels)} {series[-2]:.6f}")
+                lines.append(f"{self.name}_count{labelText(self.labels, labels)} {series[-1]}")
+        return lines
+
+
+def labelText(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=None):
+        metric = Histogram(name, help, labels, buckets) if buckets else Histogram(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+API_REQUESTS = REGISTRY.counter("harvester_api_requests_total", "API responses by endpoint family and status.",
+                                ("family", "status"))
+API_SECONDS = REGISTRY.histogram("harvester_api_request_seconds", "API request latency by endpoint family.",
+                                 ("family",), (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+DB_QUERIES = REGISTRY.counter("harvester_db_queries_total", "DB round trips by statement shape.", ("shape",))
+DB_ROWS = REGISTRY.counter("harvester_db_batch_rows_total", "Rows sent through executemany by statement shape.",
+                           ("shape",))
+DB_ERRORS = REGISTRY.counter("harvester_db_errors_total", "Failed statements by statement shape.", ("shape",))
+DB_SECONDS = REGISTRY.histogram("harvester_db_query_seconds", "DB round-trip time by statement shape.", ("shape",),
+                                (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+JOB_RUNS = REGISTRY.counter("harvester_job_runs_total", "Scheduled runs started.", ("job",))
+JOB_ITEMS = REGISTRY.counter("harvester_job_items_total", "Tasks (usually one per clan) processed.", ("job",))
+JOB_ERRORS = REGISTRY.counter("harvester_job_errors_total", "Tasks that raised.", ("job",))
+JOB_OVERRUNS = REGISTRY.counter("harvester_job_overruns_total", "Runs skipped because the previous one was busy.",
+                                ("job",))
+JOB_SECONDS = REGISTRY.histogram("harvester_job_duration_seconds", "Wall time of a run, first task to last.",
+                                 ("job",), (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+JOB_LAG = REGISTRY.histogram("harvester_job_lag_seconds", "Delay between a run's deadline and its dispatch.",
+                             ("job",), (0.01, 0.1, 0.5, 1, 5, 15, 60, 300))
+
+
+@lru_cache(maxsize=1024)
+def endpointFamily(endpoint):
+    # clans/#2PP/currentwar -> clans/{tag}/currentwar
+    return "/".join("{tag}" if part.startswith("#") else part for part in endpoint.split("?")[0].split("/"))
+
+
+@lru_cache(maxsize=1024)
+def statementShape(query):
+    # Verb plus the table it acts on: few enough label values, and N+1 patterns stand out in the counts
+    words = query.split()
+    verb = words[0].upper() if words else "?"
+    match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+`?(\w+)", query, re.IGNORECASE)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def observeRequest(endpoint, status, seconds):
+    family = endpointFamily(endpoint)
+    API_REQUESTS.inc(family, str(status) if status is not None else "error")
+    API_SECONDS.observe(seconds, family)
+
+
+def observeQuery(query, seconds, rows=None, failed=False):
+    shape = statementShape(query)
+    DB_QUERIES.inc(shape)
+    DB_SECONDS.observe(seconds, shape)
+    if rows:
+        DB_ROWS.inc(shape, amount=rows)
+    if failed:
+        DB_ERRORS.inc(shape)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scraped every few seconds
+
+
+def serve(port, host="127.0.0.1"):
+    """Starts the /metrics endpoint on a daemon thread. Local only unless host says otherwise."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    return server
@@ -0,0 +1,317 @@
+import ast
+import os
+import sys
+from dotenv import load_dotenv
+from DBManager import DBManager
+
+
+# database.txt is the base schema. Every change after it is a numbered migration here, applied
+# once and recorded in SchemaVersion. Statements must be safe to re-run (IF NOT EXISTS).
+MIGRATIONS = [
+    (0, "Tables for sharding, change-only snapshots and rollups", [
+        # These used to be in database.txt only, so databases built before them never got them
+        # and migration 1 (idx_cycle_time) failed there. Listed first so later migrations can rely on them.
+        # Heartbeats of running harvester processes (SHARDED=1 mode)
+        """
+        CREATE TABLE IF NOT EXISTS HarvestWorker (
+            workerID VARCHAR(100) PRIMARY KEY,
+            heartbeat DATETIME NOT NULL
+        ) ENGINE=InnoDB
+        """,
+        # Which worker currently harvests each tracked clan. No FK: a tracked clan may not be in Clan yet
+        """
+        CREATE TABLE IF NOT EXISTS ClanLease (
+            clanTag VARCHAR(15) PRIMARY KEY,
+            workerID VARCHAR(100),
+            expiresAt DATETIME,
+
+            INDEX (workerID, expiresAt)
+        ) ENGINE=InnoDB
+        """,
+        # One row per clan per snapshot cycle: every member was observed at this time. With
+        # SNAPSHOT_MODE=delta, PlayerSnapshot only gets a row when something changed, and
+        # playerSnapshot.history() rebuilds the full series from both.
+        """
+        CREATE TABLE IF NOT EXISTS SnapshotCycle (
+            clanTag VARCHAR(15),
+            time DATETIME,
+
+            PRIMARY KEY (clanTag, time)
+        ) ENGINE=InnoDB
+        """,
+        # Pre-aggregated activity and snapshot stats, maintained incrementally by Rollup.py.
+        # granularity is 'hour', 'day' or 'week'; bucket is the start of the period (weeks start Monday).
+        """
+        CREATE TABLE IF NOT EXISTS PlayerActivityRollup (
+            granularity VARCHAR(5),
+            bucket DATETIME,
+            playerTag VARCHAR(15),
+            clanTag VARCHAR(15),
+            activityCount INT NOT NULL,
+
+            PRIMARY KEY (granularity, playerTag, bucket),
+            INDEX (granularity, bucket)
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ClanActivityRollup (
+            granularity VARCHAR(5),
+            bucket DATETIME,
+            clanTag VARCHAR(15),
+            activityCount INT NOT NULL,
+            activePlayers INT NOT NULL,
+
+            PRIMARY KEY (granularity, clanTag, bucket)
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS PlayerStatRollup (
+            granularity VARCHAR(5),
+            bucket DATETIME,
+            playerTag VARCHAR(15),
+            clanTag VARCHAR(15),
+            samples INT NOT NULL,
+            maxDonations INT,
+            maxDonationsReceived INT,
+            maxBuilderBaseTrophies INT,
+            maxWarStars INT,
+            maxClanCapitalContributions INT,
+
+            PRIMARY KEY (granularity, playerTag, bucket),
+            INDEX (granularity, bucket)
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ClanStatRollup (
+            granularity VARCHAR(5),
+            bucket DATETIME,
+            clanTag VARCHAR(15),
+            members INT NOT NULL,
+            donations INT,
+            donationsReceived INT,
+
+            PRIMARY KEY (granularity, clanTag, bucket)
+        ) ENGINE=InnoDB
+        """,
+        # Start of the oldest bucket each granularity still has to recompute
+        """
+        CREATE TABLE IF NOT EXISTS RollupWatermark (
+            name VARCHAR(50) PRIMARY KEY,
+            watermark DATETIME NOT NULL
+        ) ENGINE=InnoDB
+        """,
+    ]),
+    (1, "Indexes for the harvester's access paths", [
+        # EntityIndex roster / departures (replaces the implicit FK index)
+        "CREATE INDEX IF NOT EXISTS idx_player_clan ON Player (clanTag)",
+        # warResults.checkWarEnded: ended wars without results
+        "CREATE INDEX IF NOT EXISTS idx_clanwar_state ON ClanWar (state, warID)",
+        # clanWar.saveWar: natural key lookup, either orientation
+        "CREATE INDEX IF NOT EXISTS idx_clanwar_pair_start ON ClanWar (clanTag1, clanTag2, startTime)",
+        # EntityIndex.attackKeys: covering index for the per-war dedup set
+        "CREATE INDEX IF NOT EXISTS idx_attack_war_pair ON Attack (warID, attackerTag, defenderTag)",
+        # Rollups, retention and history() range scans
+        "CREATE INDEX IF NOT EXISTS idx_activity_time ON ActivitySnapshot (time)",
+        "CREATE INDEX IF NOT EXISTS idx_snapshot_time ON PlayerSnapshot (time)",
+        "CREATE INDEX IF NOT EXISTS idx_cycle_time ON SnapshotCycle (time)",
+    ]),
+    (2, "Watermarks for incremental validation", [
+        # Last time each Tester.py check ran successfully
+        """
+        CREATE TABLE IF NOT EXISTS ValidatorWatermark (
+            name VARCHAR(50) PRIMARY KEY,
+            watermark DATETIME NOT NULL
+        ) ENGINE=InnoDB
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_clanwar_end ON ClanWar (endTime)",
+        "CREATE INDEX IF NOT EXISTS idx_attack_time ON Attack (startTime)",
+    ]),
+    (3, "Attack keyed by (war, attacker, defender); materialized war leaderboards", [
+        # Attack.startTime is when the attack was first seen, so one member's two attacks ingested
+        # in the same poll collided on (warID, attackerTag, startTime) and the second was dropped.
+        # Code already dedups on (attacker, defender), and a base can't be hit twice by one member.
+        "ALTER TABLE Attack DROP PRIMARY KEY, ADD PRIMARY KEY (warID, attackerTag, defenderTag)",
+        "DROP INDEX IF EXISTS idx_attack_war_pair ON Attack",  # Same columns as the new key
+        # Running sums kept by Leaderboard.recordAttacks; season is 'YYYY-MM' of the war's start
+        """
+        CREATE TABLE IF NOT EXISTS PlayerWarStats (
+            season CHAR(7),
+            playerTag VARCHAR(15),
+            thDiff TINYINT,
+            attacks INT NOT NULL,
+            stars INT NOT NULL,
+            destruction DECIMAL(12, 2) NOT NULL,
+            threeStars INT NOT NULL,
+
+            PRIMARY KEY (season, playerTag, thDiff)
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ClanWarStats (
+            season CHAR(7),
+            clanTag VARCHAR(15),
+            thDiff TINYINT,
+            attacks INT NOT NULL,
+            stars INT NOT NULL,
+            destruction DECIMAL(12, 2) NOT NULL,
+            threeStars INT NOT NULL,
+
+            PRIMARY KEY (season, clanTag, thDiff)
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS THMatchupStats (
+            attackerTH TINYINT,
+            defenderTH TINYINT,
+            attacks INT NOT NULL,
+            stars INT NOT NULL,
+            destruction DECIMAL(14, 2) NOT NULL,
+            threeStars INT NOT NULL,
+
+            PRIMARY KEY (attackerTH, defenderTH)
+        ) ENGINE=InnoDB
+        """,
+    ]),
+    (4, "Departures in their own table instead of all-NULL PlayerSnapshot rows", [
+        # A member the snapshot job found gone from clanTag; ends carried-forward state in history()
+        """
+        CREATE TABLE IF NOT EXISTS PlayerDeparture (
+            playerTag VARCHAR(15),
+            clanTag VARCHAR(15),
+            time DATETIME,
+
+            PRIMARY KEY (playerTag, time),
+            FOREIGN KEY (playerTag) REFERENCES Player(playerTag) ON DELETE CASCADE
+        ) ENGINE=InnoDB
+        """,
+        # Move the markers written so far; real snapshots always have a townHallLevel
+        """
+        INSERT IGNORE INTO PlayerDeparture (playerTag, clanTag, time)
+        SELECT playerTag, NULL, time FROM PlayerSnapshot WHERE townHallLevel IS NULL AND clanTag IS NULL
+        """,
+        "DELETE FROM PlayerSnapshot WHERE townHallLevel IS NULL AND clanTag IS NULL",
+    ]),
+]
+
+
+def appliedVersions(db):
+    """Versions recorded in SchemaVersion; empty if the table isn't there yet."""
+    return {row[0] for row in db.execute("SELECT version FROM SchemaVersion") or []}
+
+
+def migrate(db):
+    """Applies every pending migration in order. Stops at the first failure."""
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS SchemaVersion (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            appliedAt DATETIME NOT NULL
+        ) ENGINE=InnoDB
+        """)
+    applied = appliedVersions(db)
+
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        print(f"Applying migration {version}: {description}...")
+        try:
+            # DDL commits implicitly in MariaDB, which is why every statement must be re-runnable
+            for sql in statements:
+                with db.transaction() as tx:
+                    tx.execute(sql)
+            with db.transaction() as tx:
+                tx.execute("INSERT INTO SchemaVersion (version, description, appliedAt) VALUES (?, ?, NOW())",
+                           (version, description))
+        except Exception as e:
+            print(f"!! Migration {version} failed: {e}")
+            return False
+    return True
+
+
+# Stand-ins for the locals some queries are assembled from, so their shapes can still be explained
+SHAPE_LOCALS = {
+    "columns": "time, clanTag",  # PlayerSnapshot columns in playerSnapshot.history
+    "clans": ["#0"],  # SnapshotCycle clans in playerSnapshot.history
+    "bucket": "DATE({col})",  # A BUCKETS expression in the rollups
+    "table": "ActivitySnapshot",  # Pruned table
+    "chunk": 10000,
+}
+
+
+def queryShapes(path):
+    """
+    Every SQL string literal in a module: plain strings, plus f-strings that only use
+    module-level names or SHAPE_LOCALS. Yields (line, sql); sql is None for other f-strings.
+    """
+    with open(path) as f:
+        tree = ast.parse(f.read())
+
+    namespace = {}
+    module = os.path.splitext(os.path.basename(path))[0]
+    if module not in sys.modules:
+        __import__(module)
+    namespace.update(vars(sys.modules[module]))
+    namespace.update(SHAPE_LOCALS)
+
+    # Literal pieces of an f-string are not queries of their own
+    fragments = {id(v) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for v in node.values}
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            if id(node) in fragments:
+                continue
+            sql = node.value
+        elif isinstance(node, ast.JoinedStr):
+            try:
+                sql = eval(compile(ast.Expression(node), path, "eval"), namespace)
+            except Exception:
+                sql = None
+                if not any(isinstance(v, ast.Constant) and isinstance(v.value, str) and
+                           v.value.strip().upper().startswith(("SELECT", "UPDATE", "DELETE")) for v in node.values):
+                    continue
+        else:
+            continue
+
+        if sql is None or sql.strip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+            yield node.lineno, sql
+
+
+def explainQueries(db, paths=("Fetcher.py", "Sharding.py", "Rollup.py")):
+    """
+    Runs EXPLAIN on each query shape and flags full table scans (type ALL). Placeholders are
+    bound to '0', so this shows which access path is possible, not real selectivity.
+    Returns the number of flagged queries.
+    """
+    flagged = 0
+    for path in paths:
+        for line, sql in queryShapes(path):
+            if sql is None:
+                print(f"[SKIP] {path}:{line} built from local variables")
+                continue
+
+            shape = " ".join(sql.split())
+            try:
+                with db.transaction() as tx:
+                    plan = tx.execute("EXPLAIN " + sql.strip().rstrip(";"), ("0",) * sql.count("?"))
+            except Exception as e:
+                print(f"[ERROR] {path}:{line} {shape[:80]}: {e}")
+                continue
+
+            # Reading a whole table is only a problem when the query filters it
+            scans = [f"{row[2]} (~{row[8]} rows)" for row in plan if row[3] == "ALL" and "WHERE" in shape.upper()]
+            if scans:
+                flagged += 1
+                print(f"[SCAN] {path}:{line} {shape[:80]}\n       full scan of {', '.join(scans)}")
+            else:
+                print(f"[OK]   {path}:{line} {shape[:80]}")
+    return flagged
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    db = DBManager(os.environ.get("DB_HOST"), os.environ.get("DB_USER"),
+                   os.environ.get("DB_PASSWORD"), os.environ.get("DB_NAME"))
+
+    if "--explain" in sys.argv:
+        sys.exit(1 if explainQueries(db) else 0)
+    sys.exit(0 if migrate(db) else 1)
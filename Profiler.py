@@ -0,0 +1,156 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# The capture the current thread's task belongs to, if its job is being profiled
+local = threading.local()
+
+
+def activeCapture():
+    return getattr(local, "capture", None)
+
+
+def record(stage, seconds, capture=None):
+    capture = capture or activeCapture()
+    if capture is not None:
+        capture.add(stage, seconds)
+
+
+@contextmanager
+def span(stage, capture=None):
+    """Adds the wall time of the block to `stage` in the active capture; free when nothing is profiled."""
+    capture = capture or activeCapture()
+    if capture is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        capture.add(stage, time.perf_counter() - started)
+
+
+class Capture:
+    """One profiled run of a job: cProfile stats merged over all its tasks, plus stage spans."""
+
+    def __init__(self, directory, job):
+        self.directory = directory
+        self.job = job
+        self.started = datetime.now()
+        self.clock = time.perf_counter()
+        self.lock = threading.Lock()
+        self.stats = None
+        self.spans = {}  # stage -> [seconds, count]
+        self.tasks = 0
+
+    def run(self, task):
+        local.capture = self
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            profile = None  # Another profiler owns this interpreter; spans still work
+        try:
+            task()
+        finally:
+            if profile is not None:
+                profile.disable()
+            local.capture = None
+            with self.lock:
+                self.tasks += 1
+                if profile is not None:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profile)
+                    else:
+                        self.stats.add(profile)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            total = self.spans.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def end(self):
+        wall = time.perf_counter() - self.clock
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{self.job}-{self.started:%Y%m%d-%H%M%S}")
+
+        out = io.StringIO()
+        out.write(f"job {self.job}  started {self.started:%Y-%m-%d %H:%M:%S}  wall {wall:.2f}s  tasks {self.tasks}\n\n")
+        # Stages overlap (a JSON decode happens inside an API wait, tasks run side by side), so totals can exceed wall
+        out.write(f"{'stage':<16} {'total':>10} {'count':>8} {'mean':>10}\n")
+        for stage, (seconds, count) in sorted(self.spans.items(), key=lambda s: -s[1][0]):
+            out.write(f"{stage:<16} {seconds:>9.3f}s {count:>8} {seconds / count * 1000:>8.2f}ms\n")
+
+        if self.stats is not None:
+            self.stats.dump_stats(base + ".prof")  # For snakeviz / pstats diffs between releases
+            out.write("\n")
+            self.stats.stream = out
+            self.stats.sort_stats("cumulative").print_stats(40)
+
+        with open(base + ".txt", "w") as f:
+            f.write(out.getvalue())
+        print(f"Profile of '{self.job}' written to {base}.txt")
+
+
+class Profiler:
+    """
+    Profiles the next N runs of a named job without restarting the harvester. Arm it by writing
+    "<job> [runs]" lines to the control file (picked up by the watchdog within a few seconds), or
+    with SIGUSR1, which arms PROFILE_JOB for PROFILE_RUNS runs. Output goes to PROFILE_DIR.
+    """
+
+    def __init__(self, directory=None, control_file=None):
+        self.directory = directory or os.environ.get("PROFILE_DIR", "profiles")
+        self.control_file = control_file or os.environ.get("PROFILE_CONTROL", "profile.request")
+        self.lock = threading.Lock()
+        self.armed = {}  # job name (lower case) -> runs left
+        self.signalled = False
+
+    def arm(self, job, runs=1):
+        with self.lock:
+            self.armed[job.lower()] = self.armed.get(job.lower(), 0) + runs
+        print(f"Profiling armed for the next {runs} run(s) of '{job}'.")
+
+    def onSignal(self, *_):
+        # Signal handlers interrupt the main thread, so only set a flag here; poll() does the work
+        self.signalled = True
+
+    def poll(self):
+        if self.signalled:
+            self.signalled = False
+            self.arm(os.environ.get("PROFILE_JOB", "Snapshot"), int(os.environ.get("PROFILE_RUNS", 1)))
+
+        try:
+            with open(self.control_file) as f:
+                lines = f.read().splitlines()
+            os.remove(self.control_file)
+        except OSError:
+            return
+
+        for line in lines:
+            parts = line.split()
+            if not parts:
+                continue
+            try:
+                self.arm(parts[0], int(parts[1]) if len(parts) > 1 else 1)
+            except ValueError:
+                print(f"!! Bad profile request: {line!r}")
+
+    def begin(self, job):
+        """A Capture if this run of `job` should be profiled, else None."""
+        with self.lock:
+            left = self.armed.get(job.lower(), 0)
+            if not left:
+                return None
+            if left == 1:
+                del self.armed[job.lower()]
+            else:
+                self.armed[job.lower()] = left - 1
+        return Capture(self.directory, job)
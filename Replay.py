@@ -0,0 +1,231 @@
+import argparse
+import glob
+import heapq
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from DBManager import DBManager
+from Fetcher import EntityIndex, PlayerStateStore, ResponseRecorder, clan, clanWar, warResults
+from Migrations import migrate
+from Profiler import Capture
+
+
+# A snapshot cycle's player fetches follow its clans/{tag} response; members still missing after this
+# long are served from the last payload seen for them (the live run would have hit its cache)
+CYCLE_WINDOW = timedelta(seconds=int(os.environ.get("REPLAY_CYCLE_WINDOW", 600)))
+
+
+def readCapture(path):
+    """
+    (time, endpoint, status, data) per recorded response. The gzip members are inflated one at a time,
+    so a file whose recorder was killed still gives everything up to its last sync flush.
+    """
+    inflate = zlib.decompressobj(31)
+    started = False  # The current member has input
+    tail = b""
+    with open(path, "rb") as f:
+        try:
+            while chunk := f.read(1 << 20):
+                while chunk:
+                    started = True
+                    tail += inflate.decompress(chunk)
+                    chunk = b""
+                    if inflate.eof:
+                        # Another member may follow (files written by older recorders)
+                        chunk, inflate, started = inflate.unused_data, zlib.decompressobj(31), False
+                *lines, tail = tail.split(b"\n")
+                for line in lines:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        print(f"!! {path} has an unreadable record; replaying what was read")
+                        return
+                    yield datetime.fromisoformat(record["time"]), record["endpoint"], record["status"], record["data"]
+        except zlib.error as e:
+            print(f"!! {path} is corrupt ({e}); replaying what was read")
+            return
+    if started:
+        print(f"!! {path} ends early (recorder killed?); replaying what was read")
+
+
+def capturePaths(args):
+    """Capture files for each argument: a file, a directory of captures, or a CAPTURE_FILE setting."""
+    paths = []
+    for arg in args:
+        if os.path.isdir(arg):
+            paths += sorted(glob.glob(os.path.join(glob.escape(arg), "*.gz")))
+        elif os.path.isfile(arg):
+            paths.append(arg)
+        else:
+            paths += ResponseRecorder.processFiles(arg)
+    return list(dict.fromkeys(paths))
+
+
+def readCaptures(paths):
+    # Rotated files or several workers' captures merge into one timeline
+    return heapq.merge(*(readCapture(p) for p in paths), key=lambda r: r[0])
+
+
+class ReplaySession:
+    """Stands in for FetchSession: the code paths get captured payloads instead of API calls."""
+
+    def __init__(self, db):
+        self.db = db
+        self.index = EntityIndex(db)
+        self.states = PlayerStateStore(db)
+        self.responses = {}  # endpoint -> last captured payload
+        self.overlay = {}  # endpoint -> payload the current call should see instead
+
+    def getData(self, endpoint, retry=True):
+        data = self.overlay.get(endpoint)
+        return data if data is not None else self.responses.get(endpoint)
+
+    def getMany(self, endpoints, retry=True):
+        return {e: self.getData(e) for e in endpoints}
+
+
+class Cycle:
+    """A clans/{tag} response and the member payloads fetched after it."""
+
+    def __init__(self, time, data):
+        self.time = time
+        self.data = data
+        self.waiting = {m['tag'] for m in data.get('memberList', [])}
+        self.players = {}  # endpoint -> payload
+
+
+class Replayer:
+    """
+    Feeds captured responses through the harvester's own code paths, stamped with their capture times:
+    clans/{tag} plus the players/{tag} after it -> clan.savePlayersSnapshot (Player, PlayerSnapshot,
+    SnapshotCycle, departures); clans/{tag}/currentwar -> clanWar (ClanWar, WarPlayer, Attack,
+    WarResults, leaderboards); clans/{tag}/members -> clan.savePlayersActivity (ActivitySnapshot).
+    Every clans/{tag} response starts a snapshot cycle, including the ones a live run made at boot.
+    Buffered rows are written in large batches; wars keep their one transaction per payload.
+    """
+
+    def __init__(self, db):
+        self.session = ReplaySession(db)
+        self.clans = {}  # tag -> clan
+        self.cycles = {}  # clanTag -> open Cycle
+        self.counts = {"records": 0, "skipped": 0, "cycles": 0, "wars": 0, "activity": 0}
+
+    def run(self, records, bulk_rows=None):
+        with self.session.db.bulk(bulk_rows):
+            for t, endpoint, status, data in records:
+                self.counts["records"] += 1
+                self.expire(t)
+                if status not in (200, 304) or data is None:
+                    self.counts["skipped"] += 1
+                    continue
+                self.feed(t, endpoint, data)
+            self.expire(None)
+
+        # Same backstop the WarResults job runs, for wars whose warEnded payload was never captured
+        warResults.checkWarEnded(self.session)
+        return self.counts
+
+    def feed(self, t, endpoint, data):
+        parts = endpoint.split("?")[0].split("/")
+        if parts[0] == "players" and len(parts) == 2:
+            self.session.responses[endpoint] = data
+            tag = parts[1]
+            for clanTag, cycle in list(self.cycles.items()):
+                if tag in cycle.waiting:
+                    cycle.waiting.discard(tag)
+                    cycle.players[endpoint] = data
+                    if not cycle.waiting:
+                        self.snapshot(clanTag, self.cycles.pop(clanTag))
+        elif parts[0] != "clans" or len(parts) < 2:
+            self.counts["skipped"] += 1  # leaguetiers and the like
+        elif len(parts) == 2:
+            if parts[1] in self.cycles:
+                self.snapshot(parts[1], self.cycles.pop(parts[1]))
+            self.cycles[parts[1]] = Cycle(t, data)
+        elif parts[2] == "currentwar":
+            clanWar(self.session, parts[1], data, time=t)
+            self.counts["wars"] += 1
+        elif parts[2] == "members":
+            self.activity(parts[1], t, endpoint, data)
+        else:
+            self.counts["skipped"] += 1
+
+    def expire(self, now):
+        # None closes everything (end of capture)
+        for clanTag, cycle in list(self.cycles.items()):
+            if now is None or now - cycle.time > CYCLE_WINDOW:
+                self.snapshot(clanTag, self.cycles.pop(clanTag))
+
+    def clan(self, tag, data):
+        c = self.clans.get(tag)
+        if c is None:
+            # Roster from the DB when replaying onto existing data, empty otherwise
+            c = (clan.warmStart(tag, self.session) or
+                 clan.warmStart(tag, self.session, {"name": data['name'], "level": data['clanLevel'], "players": []}))
+            self.clans[tag] = c
+        c.data, c.name, c.level = data, data['name'], data['clanLevel']
+        c.saveClanData()
+        return c
+
+    def snapshot(self, tag, cycle):
+        c = self.clan(tag, cycle.data)
+        self.session.overlay = dict(cycle.players)
+        self.session.overlay[f"clans/{tag}"] = cycle.data
+        try:
+            c.savePlayersSnapshot(time=cycle.time)
+        finally:
+            self.session.overlay = {}
+        self.counts["cycles"] += 1
+
+    def activity(self, tag, t, endpoint, data):
+        c = self.clans.get(tag)
+        if c is None:
+            return  # Nothing to compare against until the clan's first snapshot cycle
+        self.session.overlay = {endpoint: data}
+        try:
+            c.savePlayersActivity(time=t)
+        finally:
+            self.session.overlay = {}
+        self.counts["activity"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the database from CAPTURE_FILE recordings.")
+    parser.add_argument("captures", nargs="+",
+                        help="capture files (.jsonl.gz), directories of them or the CAPTURE_FILE setting; merged by time")
+    parser.add_argument("--bulk-rows", type=int, default=None, help="buffered rows per transaction")
+    parser.add_argument("--profile", action="store_true", help="write a profile of the replay to PROFILE_DIR")
+    args = parser.parse_args()
+
+    paths = capturePaths(args.captures)
+    if not paths:
+        parser.error(f"no capture files found for {' '.join(args.captures)}")
+
+    load_dotenv()
+    db = DBManager(os.environ.get("DB_HOST"), os.environ.get("DB_USER"),
+                   os.environ.get("DB_PASSWORD"), os.environ.get("DB_NAME"))
+    if not migrate(db):
+        sys.exit(1)
+
+    replayer = Replayer(db)
+    started = time.perf_counter()
+    if args.profile:
+        capture = Capture(os.environ.get("PROFILE_DIR", "profiles"), "Replay")
+        capture.run(lambda: replayer.run(readCaptures(paths), args.bulk_rows))
+        capture.end()
+    else:
+        replayer.run(readCaptures(paths), args.bulk_rows)
+
+    elapsed = time.perf_counter() - started
+    counts = replayer.counts
+    print(f"Replayed {counts['records']} records in {elapsed:.1f}s ({counts['records'] / max(elapsed, 1e-9):.0f}/s): "
+          f"{counts['cycles']} snapshot cycles, {counts['wars']} war polls, {counts['activity']} activity runs, "
+          f"{counts['skipped']} skipped")
+
+
+if __name__ == "__main__":
+    main()
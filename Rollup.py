@@ -0,0 +1,244 @@
+from datetime import datetime, timedelta
+from os import environ
+
+
+# Bucket start for each granularity, in SQL and in Python (weeks start on Monday)
+BUCKETS = {
+    "hour": "DATE({col}) + INTERVAL HOUR({col}) HOUR",
+    "day": "DATE({col})",
+    "week": "DATE({col}) - INTERVAL WEEKDAY({col}) DAY",
+}
+
+
+# Snapshot columns the stat rollups aggregate, and their upsert
+STAT_COLUMNS = ("ps.clanTag, ps.donations, ps.donationsRecieved, ps.builderBaseTrophies, ps.warStars, "
+                "ps.clanCapitalContributions")
+STAT_UPDATES = """
+    ON DUPLICATE KEY UPDATE clanTag = VALUES(clanTag), samples = VALUES(samples),
+        maxDonations = VALUES(maxDonations), maxDonationsReceived = VALUES(maxDonationsReceived),
+        maxBuilderBaseTrophies = VALUES(maxBuilderBaseTrophies), maxWarStars = VALUES(maxWarStars),
+        maxClanCapitalContributions = VALUES(maxClanCapitalContributions)
+    """
+
+
+def bucketStart(granularity, t):
+    if granularity == "hour":
+        return t.replace(minute=0, second=0, microsecond=0)
+    day = t.replace(hour=0, minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return day
+    return day - timedelta(days=day.weekday())
+
+
+class RollupManager:
+    """
+    Keeps hourly/daily/weekly aggregates of ActivitySnapshot and PlayerSnapshot per player and
+    per clan. Each run only recomputes buckets from the stored watermark onwards (the bucket that
+    was still open last time, plus anything newer), then moves the watermark to the open bucket.
+    Only hours read raw rows; days and weeks are built from the hourly rows (counts add, maxima combine).
+    prune() deletes raw rows older than RETENTION_DAYS, but never rows whose buckets aren't rolled up.
+    In SNAPSHOT_MODE=delta an unchanged player has no row in a bucket, so hourly stats carry each
+    player's last stored state forward across their clan's SnapshotCycle rows (see carriedStats).
+    """
+
+    def __init__(self, db, retention_days=None):
+        self.db = db
+        self.delta = environ.get("SNAPSHOT_MODE", "full") == "delta"
+        if retention_days is None:
+            retention_days = int(environ.get("RETENTION_DAYS", 0))
+        self.retention_days = retention_days  # 0 keeps raw rows forever
+
+    def watermark(self, name):
+        rows = self.db.execute("SELECT watermark FROM RollupWatermark WHERE name = ?", (name,))
+        return rows[0][0] if rows else datetime(1970, 1, 1)
+
+    def run(self, now=None):
+        # Rows are buffered for up to DB_BUFFER_SECONDS before they land, so leave a little slack
+        now = (now or datetime.now()) - timedelta(minutes=5)
+        for granularity, bucket in BUCKETS.items():
+            since = self.watermark(granularity)
+            with self.db.transaction() as tx:
+                self.rollActivity(tx, granularity, bucket, since)
+                self.rollStats(tx, granularity, bucket, since)
+                tx.execute("""
+                    INSERT INTO RollupWatermark (name, watermark) VALUES (?, ?)
+                    ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)
+                    """, (granularity, bucketStart(granularity, now)))
+
+    def rollActivity(self, tx, granularity, bucket, since):
+        if granularity == "hour":
+            # ActivitySnapshot has no clanTag; players are attributed to their current clan
+            source = f"""
+                SELECT ?, {bucket.format(col="a.time")} AS b, a.playerTag, MAX(p.clanTag), COUNT(*)
+                FROM ActivitySnapshot a
+                LEFT JOIN Player p ON p.playerTag = a.playerTag
+                WHERE a.time >= ?
+                GROUP BY b, a.playerTag
+                """
+        else:
+            source = f"""
+                SELECT ?, {bucket.format(col="bucket")} AS b, playerTag, MAX(clanTag), SUM(activityCount)
+                FROM PlayerActivityRollup
+                WHERE granularity = 'hour' AND bucket >= ?
+                GROUP BY b, playerTag
+                """
+        tx.execute(f"""
+            INSERT INTO PlayerActivityRollup (granularity, bucket, playerTag, clanTag, activityCount)
+            {source}
+            ON DUPLICATE KEY UPDATE clanTag = VALUES(clanTag), activityCount = VALUES(activityCount)
+            """, (granularity, since))
+
+        tx.execute("""
+            INSERT INTO ClanActivityRollup (granularity, bucket, clanTag, activityCount, activePlayers)
+            SELECT granularity, bucket, clanTag, SUM(activityCount), COUNT(*)
+            FROM PlayerActivityRollup
+            WHERE granularity = ? AND bucket >= ? AND clanTag IS NOT NULL
+            GROUP BY granularity, bucket, clanTag
+            ON DUPLICATE KEY UPDATE activityCount = VALUES(activityCount), activePlayers = VALUES(activePlayers)
+            """, (granularity, since))
+
+    def rollStats(self, tx, granularity, bucket, since):
+        if granularity == "hour" and self.delta:
+            tx.executemany(f"""
+                INSERT INTO PlayerStatRollup (granularity, bucket, playerTag, clanTag, samples, maxDonations,
+                    maxDonationsReceived, maxBuilderBaseTrophies, maxWarStars, maxClanCapitalContributions)
+                VALUES ('hour', ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                {STAT_UPDATES}
+                """, self.carriedStats(tx, since))
+        else:
+            if granularity == "hour":
+                source = f"""
+                    SELECT ?, {bucket.format(col="time")} AS b, playerTag, MAX(clanTag), COUNT(*), MAX(donations),
+                        MAX(donationsRecieved), MAX(builderBaseTrophies), MAX(warStars), MAX(clanCapitalContributions)
+                    FROM PlayerSnapshot
+                    WHERE time >= ?
+                    GROUP BY b, playerTag
+                    """
+            else:
+                source = f"""
+                    SELECT ?, {bucket.format(col="bucket")} AS b, playerTag, MAX(clanTag), SUM(samples),
+                        MAX(maxDonations), MAX(maxDonationsReceived), MAX(maxBuilderBaseTrophies), MAX(maxWarStars),
+                        MAX(maxClanCapitalContributions)
+                    FROM PlayerStatRollup
+                    WHERE granularity = 'hour' AND bucket >= ?
+                    GROUP BY b, playerTag
+                    """
+            tx.execute(f"""
+                INSERT INTO PlayerStatRollup (granularity, bucket, playerTag, clanTag, samples, maxDonations,
+                    maxDonationsReceived, maxBuilderBaseTrophies, maxWarStars, maxClanCapitalContributions)
+                {source}
+                {STAT_UPDATES}
+                """, (granularity, since))
+
+        tx.execute("""
+            INSERT INTO ClanStatRollup (granularity, bucket, clanTag, members, donations, donationsReceived)
+            SELECT granularity, bucket, clanTag, COUNT(*), SUM(maxDonations), SUM(maxDonationsReceived)
+            FROM PlayerStatRollup
+            WHERE granularity = ? AND bucket >= ? AND clanTag IS NOT NULL
+            GROUP BY granularity, bucket, clanTag
+            ON DUPLICATE KEY UPDATE members = VALUES(members), donations = VALUES(donations),
+                donationsReceived = VALUES(donationsReceived)
+            """, (granularity, since))
+
+    def carriedStats(self, tx, since):
+        """
+        Hourly PlayerStatRollup rows from `since` for SNAPSHOT_MODE=delta. A player's observations are
+        their stored rows plus every SnapshotCycle of the clan their last stored row was in, until a
+        PlayerDeparture; the same merge playerSnapshot.history does for one player.
+        """
+        # State going in: each player's last row before `since`, unless they left after it
+        carried = tx.execute(f"""
+            SELECT ps.playerTag, ps.time, {STAT_COLUMNS}
+            FROM PlayerSnapshot ps
+            JOIN (SELECT playerTag, MAX(time) AS time FROM PlayerSnapshot WHERE time < ? GROUP BY playerTag) latest
+              ON latest.playerTag = ps.playerTag AND latest.time = ps.time
+            LEFT JOIN (SELECT playerTag, MAX(time) AS time FROM PlayerDeparture WHERE time < ? GROUP BY playerTag) gone
+              ON gone.playerTag = ps.playerTag
+            WHERE gone.time IS NULL OR gone.time < ps.time
+            """, (since, since)) or []
+        rows = tx.execute(f"SELECT ps.playerTag, ps.time, {STAT_COLUMNS} FROM PlayerSnapshot ps WHERE ps.time >= ?",
+                          (since,)) or []
+        departures = tx.execute("SELECT playerTag, time FROM PlayerDeparture WHERE time >= ?", (since,)) or []
+        cycles = tx.execute("SELECT clanTag, time FROM SnapshotCycle WHERE time >= ?", (since,)) or []
+
+        states = {}  # playerTag -> (time, clanTag, *stats) of the last stored row
+        members = {}  # clanTag -> playerTags whose state is in that clan
+        buckets = {}  # (hour, playerTag) -> [clanTag, samples, *maxima]
+
+        def carry(row):
+            last = states.pop(row[0], None)
+            if last is not None:
+                members[last[1]].discard(row[0])
+            if len(row) > 2:
+                states[row[0]] = row[1:]
+                members.setdefault(row[2], set()).add(row[0])
+
+        def observe(playerTag, time, state):
+            entry = buckets.get((bucketStart("hour", time), playerTag))
+            if entry is None:
+                buckets[(bucketStart("hour", time), playerTag)] = [state[1], 1, *state[2:]]
+            else:
+                entry[0] = state[1]
+                entry[1] += 1
+                entry[2:] = [max(a, b) for a, b in zip(entry[2:], state[2:])]
+
+        for row in carried:
+            carry(row)
+        # At equal times stored rows come first, then departures, then cycles
+        events = sorted([(row[1], 0, row) for row in rows] + [(d[1], 1, d) for d in departures] +
+                        [(c[1], 2, c) for c in cycles], key=lambda e: (e[0], e[1]))
+        for time, kind, event in events:
+            if kind == 0:
+                carry(event)
+                observe(event[0], time, event[1:])
+            elif kind == 1:
+                carry(event)  # Departed: no state until their next row
+            else:
+                for playerTag in members.get(event[0], ()):
+                    state = states[playerTag]
+                    if state[0] != time:  # Already counted as a stored row
+                        observe(playerTag, time, state)
+
+        return [(bucket, playerTag, *values) for (bucket, playerTag), values in buckets.items()]
+
+    def prune(self, now=None, chunk=10000):
+        if not self.retention_days:
+            return
+
+        # Only rows in buckets every granularity has already closed are safe to drop
+        cutoff = (now or datetime.now()) - timedelta(days=self.retention_days)
+        cutoff = min([cutoff] + [self.watermark(g) for g in BUCKETS])
+
+        for table in ("ActivitySnapshot", "SnapshotCycle"):
+            deleted = chunk
+            while deleted >= chunk:
+                # Small chunks keep each transaction (and its locks) short
+                with self.db.transaction() as tx:
+                    tx.execute(f"DELETE FROM {table} WHERE time < ? LIMIT {int(chunk)}", (cutoff,))
+                    deleted = tx.rowcount
+
+        self.pruneSnapshots(cutoff, chunk)
+        print(f"Pruned raw snapshots older than {cutoff}.")
+
+    def pruneSnapshots(self, cutoff, chunk):
+        # Keep each player's newest row before the cutoff: delta-mode history carries it forward.
+        # A multi-table DELETE can't take a LIMIT, so players are deleted in batches of about
+        # `chunk` rows, sized from one grouped read (a player with more than that goes alone).
+        players = self.db.execute("""
+            SELECT playerTag, MAX(time), COUNT(*) - 1 FROM PlayerSnapshot
+            WHERE time < ? GROUP BY playerTag HAVING COUNT(*) > 1
+            """, (cutoff,)) or []
+
+        batch, rows = [], 0
+        for playerTag, keepTime, old in players:
+            if batch and rows + old > chunk:
+                self.deleteSnapshots(batch)
+                batch, rows = [], 0
+            batch.append((playerTag, keepTime))
+            rows += old
+        self.deleteSnapshots(batch)
+
+    def deleteSnapshots(self, batch):
+        if batch:
+            with self.db.transaction() as tx:
+                tx.executemany("DELETE FROM PlayerSnapshot WHERE playerTag = ? AND time < ?", batch)
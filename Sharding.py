@@ -0,0 +1,129 @@
+import math
+import os
+import socket
+import threading
+import time
+
+
+class LeaseManager:
+    """
+    Splits the tracked clans between harvester processes (on one box or many) through the
+    ClanLease table. Each worker heartbeats into HarvestWorker, keeps its leases alive, and
+    claims or releases clans so it holds about ceil(clans / live workers). When a worker stops
+    heartbeating, its leases expire and the survivors pick them up on their next beat.
+    All times come from the DB's NOW(), so worker clocks don't need to agree.
+    """
+
+    def __init__(self, db, clan_tags, worker_id=None, lease_seconds=None):
+        self.db = db
+        self.clan_tags = list(clan_tags)
+        self.worker_id = worker_id or os.environ.get("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds or int(os.environ.get("LEASE_SECONDS", 90))
+        self.lock = threading.Lock()
+        self.owned = set()
+        self.leader = False
+        self.running = False
+
+    def start(self):
+        # Seed the lease table with any tracked clan it doesn't have yet
+        for tag in self.clan_tags:
+            self.db.execute("INSERT IGNORE INTO ClanLease (clanTag) VALUES (?)", (tag,))
+
+        self.heartbeat()
+        self.running = True
+        threading.Thread(target=self.loop, name="Leases", daemon=True).start()
+        return self
+
+    def loop(self):
+        # Beat three times per lease so one slow beat doesn't lose the shard
+        while self.running:
+            time.sleep(self.lease_seconds / 3)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                print(f"!! Lease heartbeat failed: {e}")
+
+    def heartbeat(self):
+        db = self.db
+        db.execute("""
+            INSERT INTO HarvestWorker (workerID, heartbeat) VALUES (?, NOW())
+            ON DUPLICATE KEY UPDATE heartbeat = NOW()
+            """, (self.worker_id,))
+        db.execute("""
+            UPDATE ClanLease SET expiresAt = NOW() + INTERVAL ? SECOND
+            WHERE workerID = ? AND expiresAt > NOW()
+            """, (self.lease_seconds, self.worker_id))
+
+        live = db.execute("""
+            SELECT workerID FROM HarvestWorker WHERE heartbeat > NOW() - INTERVAL ? SECOND ORDER BY workerID
+            """, (self.lease_seconds,))
+        total = db.execute("SELECT COUNT(*) FROM ClanLease")
+        if live is None or not total:
+            return  # DB hiccup: keep the shard we have until the leases run out
+
+        workers = [row[0] for row in live] or [self.worker_id]
+        target = math.ceil(total[0][0] / len(workers))
+        owned = self.ownedTags()
+
+        if len(owned) > target:
+            # Someone joined: hand back the surplus so they can claim it
+            for tag in sorted(owned)[target:]:
+                db.execute("UPDATE ClanLease SET workerID = NULL, expiresAt = NULL WHERE clanTag = ? AND workerID = ?",
+                           (tag, self.worker_id))
+        elif len(owned) < target:
+            # Free or expired leases, claimed atomically so two workers can't both take one
+            db.execute("""
+                UPDATE ClanLease SET workerID = ?, expiresAt = NOW() + INTERVAL ? SECOND
+                WHERE workerID IS NULL OR expiresAt IS NULL OR expiresAt <= NOW()
+                ORDER BY clanTag LIMIT ?
+                """, (self.worker_id, self.lease_seconds, target - len(owned)))
+
+        owned = self.ownedTags()
+        with self.lock:
+            if owned != self.owned:
+                print(f"Shard for {self.worker_id}: {len(owned)} clans ({len(workers)} live workers).")
+            self.owned = owned
+            self.leader = workers[0] == self.worker_id
+
+    def ownedTags(self):
+        rows = self.db.execute("SELECT clanTag FROM ClanLease WHERE workerID = ? AND expiresAt > NOW()",
+                               (self.worker_id,))
+        return {row[0] for row in rows or []}
+
+    def owns(self, tag):
+        with self.lock:
+            return tag in self.owned
+
+    def tags(self):
+        with self.lock:
+            return [t for t in self.clan_tags if t in self.owned]
+
+    def isLeader(self):
+        # Exactly one live worker runs the global (not per-clan) jobs
+        with self.lock:
+            return self.leader
+
+    def stop(self):
+        # Hand the shard back right away instead of waiting for the leases to expire
+        self.running = False
+        self.db.execute("UPDATE ClanLease SET workerID = NULL, expiresAt = NULL WHERE workerID = ?", (self.worker_id,))
+        self.db.execute("DELETE FROM HarvestWorker WHERE workerID = ?", (self.worker_id,))
+
+
+class AllClans:
+    """Unsharded stand-in for LeaseManager: this process owns every tracked clan."""
+
+    def __init__(self, clan_tags):
+        self.clan_tags = list(clan_tags)
+
+    def owns(self, tag):
+        return True
+
+    def tags(self):
+        return list(self.clan_tags)
+
+    def isLeader(self):
+        return True
+
+    def stop(self):
+        pass
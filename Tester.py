@@ -1,6 +1,10 @@
 import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from DBManager import DBManager
+from Migrations import appliedVersions
 
 # ANSI Colors for pretty output
 GREEN = "\033[92m"
@@ -9,8 +13,77 @@ YELLOW = "\033[93m"
 RESET = "\033[0m"
 
 
+# (name, sql, description, severity, scope)
+# Every check counts bad records. {since} is filled with "AND <scope> >= ?" in incremental mode,
+# so only rows newer than the check's last watermark are read; scope None always checks everything.
+# Wars are scoped by endTime: a war can be first seen mid-battle, and its results land after it ends.
+CHECKS = [
+    # --- 1. LOGICAL CHECKS (Impossible Values) ---
+    ("Attack Stars Range",
+     "SELECT count(*) FROM Attack WHERE (stars < 0 OR stars > 3) {since};",
+     "Attacks found with < 0 or > 3 stars.", "FAIL", "startTime"),
+
+    ("Attack Destruction Range",
+     "SELECT count(*) FROM Attack WHERE (destruction < 0 OR destruction > 100) {since};",
+     "Attacks found with invalid destruction %.", "FAIL", "startTime"),
+
+    ("Self-Attacks",
+     "SELECT count(*) FROM Attack WHERE attackerTag = defenderTag {since};",
+     "Players attacking themselves.", "FAIL", "startTime"),
+
+    ("War Time Logic",
+     "SELECT count(*) FROM ClanWar WHERE endTime < startTime {since};",
+     "Wars where End Time is before Start Time.", "FAIL", "endTime"),
+
+    # --- 2. INTEGRITY CHECKS (Missing Links) ---
+    ("Orphaned Attacks",
+     """
+     SELECT count(*) FROM Attack a
+     LEFT JOIN WarPlayer wp ON a.attackerTag = wp.playerTag AND a.warID = wp.warID
+     WHERE wp.playerTag IS NULL {since};
+     """,
+     "Attacks linking to a player not in the WarPlayer roster.", "FAIL", "a.startTime"),
+
+    ("Orphaned Snapshots",
+     """
+     SELECT count(*) FROM PlayerSnapshot ps
+     LEFT JOIN Player p ON ps.playerTag = p.playerTag
+     WHERE p.playerTag IS NULL {since};
+     """,
+     "Player snapshots that exist for a deleted/missing Player.", "FAIL", "ps.time"),
+
+    # --- 3. WAR COMPLETION CHECKS ---
+    ("Missing War Results",
+     """
+     SELECT count(*) FROM ClanWar cw
+     LEFT JOIN WarResults wr ON cw.warID = wr.warID
+     WHERE cw.state = 'warEnded' AND wr.warID IS NULL {since};
+     """,
+     "Ended wars that have no final results calculated.", "WARN", "cw.endTime"),
+
+    ("Impossible War Scores",
+     """
+     SELECT count(*) FROM WarResults wr
+     JOIN ClanWar cw ON cw.warID = wr.warID
+     WHERE wr.totalStars > cw.teamSize * 3 {since};
+     """,
+     "War Results where stars exceed maximum possible (TeamSize * 3).", "FAIL", "cw.endTime"),
+
+    # --- 4. DUPLICATE CHECKS ---
+    ("Duplicate Active Wars",
+     """
+     SELECT count(*) FROM (
+         SELECT clanTag1, count(*) as c FROM ClanWar
+         WHERE state = 'inWar'
+         GROUP BY clanTag1 HAVING c > 1
+     ) as sub;
+     """,
+     "Clans marked as 'inWar' multiple times simultaneously.", "FAIL", None),
+]
+
+
 class DataValidator:
-    def __init__(self):
+    def __init__(self, incremental=False):
         load_dotenv()
         host = os.environ.get("DB_HOST")
         password = os.environ.get("DB_PASSWORD")
@@ -19,118 +92,91 @@ class DataValidator:
 
         print(f"🔌 Connecting to database: {db_name}...")
         self.db = DBManager(host, user, password, db_name)
-
-    def log(self, status, message, count=0):
+        # Validation only reads the schema; applying DDL is the migration script's job
+        if 2 not in appliedVersions(self.db):  # ValidatorWatermark
+            print("!! Schema is missing migration 2 (ValidatorWatermark). Run python Migrations.py first.")
+            sys.exit(1)
+
+        self.incremental = incremental
+        # Snapshot rows are buffered and committed after their timestamp,
+        # so each incremental run re-reads this much before its watermark
+        self.overlap_minutes = int(os.environ.get("VALIDATE_OVERLAP_MINUTES", 120))
+
+    def log(self, status, message, count=0, elapsed=None):
+        took = f" {elapsed:.2f}s" if elapsed is not None else ""
         if status == "PASS":
-            print(f"[{GREEN}PASS{RESET}] {message}")
+            print(f"[{GREEN}PASS{RESET}] {message}{took}")
         elif status == "FAIL":
-            print(f"[{RED}FAIL{RESET}] {message} (Found: {count})")
+            print(f"[{RED}FAIL{RESET}] {message} (Found: {count}){took}")
         elif status == "WARN":
-            print(f"[{YELLOW}WARN{RESET}] {message} (Found: {count})")
-
-    def run_check(self, name, sql, description, severity="FAIL"):
+            print(f"[{YELLOW}WARN{RESET}] {message} (Found: {count}){took}")
+
+    def watermark(self, name):
+        rows = self.db.execute("SELECT watermark FROM ValidatorWatermark WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def count(self, sql, scope, since):
+        # Own pooled connection per check; errors propagate so the watermark isn't moved past them
+        if scope and since is not None:
+            sql, params = sql.format(since=f"AND {scope} >= ? - INTERVAL ? MINUTE"), (since, self.overlap_minutes)
+        else:
+            sql, params = sql.format(since=""), ()
+        with self.db.transaction() as tx:
+            return tx.execute(sql, params)[0][0]
+
+    def run_check(self, name, sql, description, severity="FAIL", scope=None, since=None):
         """
         Generic function to run a SQL check.
-        If count > 0, it logs a FAIL or WARN.
+        Returns (status, message, count, seconds) instead of printing, so checks can run in parallel.
         """
+        start = time.perf_counter()
         try:
             # We assume the SQL query returns a COUNT of bad records
-            result = self.db.execute(sql)
-            bad_count = result[0][0]
-
+            bad_count = self.count(sql, scope, since)
             if bad_count == 0:
-                self.log("PASS", name)
-            else:
-                self.log(severity, f"{name}: {description}", bad_count)
+                return "PASS", name, 0, time.perf_counter() - start
+            return severity, f"{name}: {description}", bad_count, time.perf_counter() - start
         except Exception as e:
-            print(f"[{RED}ERROR{RESET}] Could not run check '{name}': {e}")
+            return "ERROR", f"Could not run check '{name}': {e}", 0, time.perf_counter() - start
 
     def validate_all(self):
-        print("\n--- 🔍 STARTING DATA VALIDATION ---\n")
-
-        # --- 1. LOGICAL CHECKS (Impossible Values) ---
-        self.run_check(
-            "Attack Stars Range",
-            "SELECT count(*) FROM Attack WHERE stars < 0 OR stars > 3;",
-            "Attacks found with < 0 or > 3 stars."
-        )
-
-        self.run_check(
-            "Attack Destruction Range",
-            "SELECT count(*) FROM Attack WHERE destruction < 0 OR destruction > 100;",
-            "Attacks found with invalid destruction %."
-        )
-
-        self.run_check(
-            "Self-Attacks",
-            "SELECT count(*) FROM Attack WHERE attackerTag = defenderTag;",
-            "Players attacking themselves."
-        )
-
-        self.run_check(
-            "War Time Logic",
-            "SELECT count(*) FROM ClanWar WHERE endTime < startTime;",
-            "Wars where End Time is before Start Time."
-        )
-
-        # --- 2. INTEGRITY CHECKS (Missing Links) ---
-        self.run_check(
-            "Orphaned Attacks",
-            """
-            SELECT count(*) FROM Attack a 
-            LEFT JOIN WarPlayer wp ON a.attackerTag = wp.playerTag AND a.warID = wp.warID 
-            WHERE wp.playerTag IS NULL;
-            """,
-            "Attacks linking to a player not in the WarPlayer roster."
-        )
-
-        self.run_check(
-            "Orphaned Snapshots",
-            """
-            SELECT count(*) FROM PlayerSnapshot ps 
-            LEFT JOIN Player p ON ps.playerTag = p.playerTag 
-            WHERE p.playerTag IS NULL;
-            """,
-            "Player snapshots that exist for a deleted/missing Player."
-        )
-
-        # --- 3. WAR COMPLETION CHECKS ---
-        self.run_check(
-            "Missing War Results",
-            """
-            SELECT count(*) FROM ClanWar cw 
-            LEFT JOIN WarResults wr ON cw.warID = wr.warID 
-            WHERE cw.state = 'warEnded' AND wr.warID IS NULL;
-            """,
-            "Ended wars that have no final results calculated.",
-            severity="WARN"
-        )
-
-        self.run_check(
-            "Impossible War Scores",
-            """
-            SELECT count(*) FROM WarResults 
-            WHERE totalStars > (SELECT teamSize * 3 FROM ClanWar WHERE ClanWar.warID = WarResults.warID);
-            """,
-            "War Results where stars exceed maximum possible (TeamSize * 3)."
-        )
-
-        # --- 4. DUPLICATE CHECKS ---
-        self.run_check(
-            "Duplicate Active Wars",
-            """
-            SELECT count(*) FROM (
-                SELECT clanTag1, count(*) as c FROM ClanWar 
-                WHERE state = 'inWar' 
-                GROUP BY clanTag1 HAVING c > 1
-            ) as sub;
-            """,
-            "Clans marked as 'inWar' multiple times simultaneously."
-        )
-
-        print("\n--- ✅ VALIDATION COMPLETE ---\n")
+        mode = "INCREMENTAL" if self.incremental else "FULL"
+        print(f"\n--- 🔍 STARTING DATA VALIDATION ({mode}) ---\n")
+
+        # Taken before any check runs: rows landing mid-run are covered by the next one
+        now = self.db.execute("SELECT NOW()")[0][0]
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=min(len(CHECKS), self.db.pool_size)) as pool:
+            futures = []
+            for name, sql, description, severity, scope in CHECKS:
+                since = self.watermark(name) if self.incremental and scope else None
+                futures.append(pool.submit(self.run_check, name, sql, description, severity, scope, since))
+
+            # Reported in declaration order, whatever order they finish in
+            results = []
+            for (name, *_), future in zip(CHECKS, futures):
+                status, message, count, elapsed = future.result()
+                results.append(status)
+                if status == "ERROR":
+                    print(f"[{RED}ERROR{RESET}] {message}")
+                    continue
+                self.log(status, message, count, elapsed)
+                self.db.execute("""
+                    INSERT INTO ValidatorWatermark (name, watermark) VALUES (?, ?)
+                    ON DUPLICATE KEY UPDATE watermark = VALUES(watermark)
+                    """, (name, now))
+
+        print(f"\n--- ✅ VALIDATION COMPLETE ({time.perf_counter() - started:.2f}s) ---\n")
+        return results
 
 
 if __name__ == "__main__":
-    validator = DataValidator()
-    validator.validate_all()
\ No newline at end of file
+    # python Tester.py [--incremental] [--every MINUTES]
+    every = float(sys.argv[sys.argv.index("--every") + 1]) if "--every" in sys.argv else 0
+    validator = DataValidator(incremental="--incremental" in sys.argv)
+    while True:
+        validator.validate_all()
+        if not every:
+            break
+        time.sleep(every * 60)
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+import textwrap
+from Fetcher import ResponseRecorder
+from Replay import capturePaths, readCaptures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def record(capture, first, count, crash):
+    """Runs a recorder in its own process: count responses, each synced, then a crash or a clean exit."""
+    script = textwrap.dedent(f"""
+        import os
+        from Fetcher import ResponseRecorder
+        recorder = ResponseRecorder({capture!r}, flush_seconds=0)
+        for n in range({first}, {first + count}):
+            recorder.record(f"players/#{{n}}", 200, {{"n": n}})
+        if {crash}:
+            recorder.flush_seconds = 3600
+            recorder.record("players/#lost", 200, {{"n": -1}})  # Never synced
+            os._exit(1)  # No atexit: the gzip member is left unterminated
+        """)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [HERE, os.environ.get("PYTHONPATH")])))
+    subprocess.run([sys.executable, "-c", script], env=env, cwd=HERE, check=not crash)
+
+
+def replayed(capture):
+    return [data["n"] for _, _, _, data in readCaptures(capturePaths([capture]))]
+
+
+def test_crash_between_clean_runs(tmp_path):
+    capture = str(tmp_path / "capture.jsonl.gz")
+    record(capture, 0, 5, crash=False)
+    record(capture, 5, 5, crash=True)
+    record(capture, 10, 5, crash=False)
+
+    assert len(ResponseRecorder.processFiles(capture)) == 3
+    assert sorted(replayed(capture)) == list(range(15))
+
+
+def test_crash_on_first_run(tmp_path):
+    capture = str(tmp_path / "capture.jsonl.gz")
+    record(capture, 0, 5, crash=True)
+    record(capture, 5, 5, crash=False)
+
+    assert sorted(replayed(capture)) == list(range(10))
+    assert sorted(replayed(str(tmp_path))) == list(range(10))  # The directory works too
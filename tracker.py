@@ -3,13 +3,24 @@ import os
 import time
 import socket
 import threading
-import asyncio
-import dotenv
+import heapq
+import itertools
+import json
+import math
+import random
+import signal
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Path setup
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from Fetcher import FetchSession, clan, clanWar, warResults, attack
+from Fetcher import FetchSession, clan, clanWar, warResults
+from KeyManager import KeyManager
+from Sharding import LeaseManager, AllClans
+from Rollup import RollupManager
+from Migrations import migrate
+import Metrics
+from Profiler import Profiler
 
 # --- CONFIG ---
 clan_tags = [
@@ -19,7 +30,18 @@ clan_tags = [
     "#2GLC0G2JR", "#22G0JJR8", "#2RVGUQ0R2", "#JCCYQPYL", "#2Y09JUL9R", "#CPVJYJQV",
     "#2G28J89UQ", "#8GR2GRJR", "#2CC0CJVC", "#2YVJU0GCU"
 ]
+# Rebuild rosters from checkpoint/DB at boot instead of re-crawling every player (WARM_START=0 disables)
+WARM_START = os.environ.get("WARM_START", "1") != "0"
+CHECKPOINT_FILE = os.environ.get("CHECKPOINT_FILE", "harvester_checkpoint.json")
+WORKERS = int(os.environ.get("WORKERS", 8))  # Shared by every job; keep DB_POOL_SIZE >= this
+# Split clan_tags between several harvester processes through ClanLease (see Sharding.py)
+SHARDED = os.environ.get("SHARDED", "0") == "1"
+# Prometheus-style /metrics on localhost (0 disables; give each worker on one box its own port)
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9108))
 internet_event = threading.Event()
+# Tags being crawled right now (by refresh_rosters or the Snapshot job), so no clan is built twice
+building = set()
+building_lock = threading.Lock()
 
 
 def log(message):
@@ -36,40 +58,250 @@ def check_internet_connection(host="8.8.8.8", port=53, timeout=3):
 
 
 def get_valid_token():
-    # Helper for asyncio loop
-    async def fetch():
-        dotenv.load_dotenv()
-        email = os.environ.get("COC_EMAIL")
-        password = os.environ.get("COC_PASSWORD")
-        import coc
-        async with coc.Client() as client:
-            await client.login(email, password)
-            http = client.http
-            if hasattr(http, 'keys'):
-                return next(iter(http.keys))
-            raise Exception("No API keys found.")
+    # Single fresh key, for FetchSession(token=...) users; the harvester itself uses a KeyManager
+    return KeyManager(key_count=1).login()[0]
 
-    return asyncio.run(fetch())
 
+def save_checkpoint(clans):
+    state = {"savedAt": datetime.now().isoformat(), "clans": [c.checkpoint() for c in list(clans)]}
+    tmp = CHECKPOINT_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, CHECKPOINT_FILE)  # Never leave a half-written checkpoint behind
+    except OSError as e:
+        log(f"!! Could not write checkpoint: {e}")
 
-def run_job_safe(interval_minutes, func, job_name):
 
-    log(f"Thread '{job_name}' initialized.")
+def load_checkpoint():
+    try:
+        with open(CHECKPOINT_FILE) as f:
+            state = json.load(f)
+        log(f"Checkpoint from {state['savedAt']} found.")
+        return {c["tag"]: c for c in state["clans"]}
+    except (OSError, ValueError, KeyError):
+        return {}
 
-    while True:
 
-        internet_event.wait()
+def load_clans(session, shard):
+    """Warm-starts every clan we already know. Returns (clans, owned tags that still need a full crawl)."""
+    if not WARM_START:
+        return [], shard.tags()
+
+    checkpoint = load_checkpoint()
+    clans, cold = [], []
+    for tag in clan_tags:
+        c = clan.warmStart(tag, session, checkpoint.get(tag))
+        if c:
+            clans.append(c)
+        elif shard.owns(tag):
+            cold.append(tag)
+    return clans, cold
+
+
+def build_clan(tag, session, clans):
+    with building_lock:
+        if tag in building or any(c.clanTag == tag for c in list(clans)):
+            return
+        building.add(tag)
+    try:
+        clans.append(clan(tag, session))
+    except Exception as e:
+        log(f"Skipping clan {tag}: {e}")
+    finally:
+        with building_lock:
+            building.discard(tag)
 
-        try:
-            # 2. Execute the job
-            func()
 
+def serially(c, task):
+    # A clan's roster refresh and its scheduled runs all replace its players: one at a time per clan
+    def run():
+        with c.lock:
+            task()
+    return run
+
+
+def refresh_rosters(clans, cold, session, shard):
+    # Background: crawl unknown clans, then reconcile warm rosters with the API, a few clans at a time
+    def build(tag):
+        build_clan(tag, session, clans)
+
+    def refresh(c):
+        try:
+            serially(c, c.refreshRoster)()
         except Exception as e:
-            log(f"!! Error in '{job_name}': {e}")
-            # We don't exit. We just log and sleep.
+            log(f"!! Roster refresh failed for {c.clanTag}: {e}")
+
+    warm = [c for c in clans if shard.owns(c.clanTag)]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(build, cold))
+        list(pool.map(refresh, warm))
+    log(f"Rosters refreshed for {len(clans)} clans.")
+
+
+class Job:
+    def __init__(self, name, interval_minutes, tasks, jitter, spread, finish):
+        self.name = name
+        self.interval = interval_minutes * 60
+        self.tasks = tasks
+        self.jitter = jitter
+        self.spread = spread
+        self.finish = finish
+        self.capture = None  # Profiler capture for the current run, if it was armed
+
+        self.anchor = time.monotonic() + random.uniform(0, jitter * self.interval)  # Decorrelate jobs
+        self.tick = 0
+        self.pending = 0
+        self.started = None
+        self.last_start = None
+
+        # Stats since the last report
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.errors = 0
+        self.lags = []
+        self.cadences = []
+        self.durations = []
+
+
+class Scheduler:
+    """
+    Fixed-rate scheduler for all jobs. Deadlines sit on a grid (anchor + n * interval, plus jitter)
+    so they don't drift with runtime, and a job never overlaps itself: if the previous run is
+    still busy at the next deadline, that run is counted as an overrun and skipped.
+    Each run's tasks (e.g. one per clan) go to one shared worker pool, staggered over the first
+    `spread` fraction of the interval instead of all firing at once.
+    """
+
+    def __init__(self, workers, profiler=None):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Job")
+        self.profiler = profiler
+        self.jobs = []
+        self.queue = []  # heap of (when, seq, action, job, task)
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def add(self, name, interval_minutes, tasks, jitter=0.05, spread=0.5, finish=None):
+        """tasks() returns the callables for one run; finish() runs once they have all completed."""
+        job = Job(name, interval_minutes, tasks, jitter, spread, finish)
+        self.jobs.append(job)
+        self.push(job.anchor, self.dispatch, job)
+        log(f"Job '{name}' scheduled every {interval_minutes} min.")
+
+    def push(self, when, action, job, task=None):
+        with self.cond:
+            heapq.heappush(self.queue, (when, next(self.seq), action, job, task))
+            self.cond.notify()
+
+    def start(self):
+        threading.Thread(target=self.loop, name="Scheduler", daemon=True).start()
+
+    def loop(self):
+        while True:
+            internet_event.wait()  # Nothing is dispatched while offline
+
+            with self.cond:
+                while not self.queue or self.queue[0][0] > time.monotonic():
+                    self.cond.wait(self.queue[0][0] - time.monotonic() if self.queue else None)
+                when, _, action, job, task = heapq.heappop(self.queue)
+
+            action(job, when, task)
+
+    def dispatch(self, job, when, _=None):
+        now = time.monotonic()
+
+        # Next grid point; deadlines missed while offline are skipped rather than replayed
+        job.tick = max(job.tick + 1, math.ceil((now - job.anchor) / job.interval))
+        self.push(job.anchor + job.tick * job.interval + random.uniform(0, job.jitter * job.interval),
+                  self.dispatch, job)
+
+        with self.cond:
+            busy = job.pending > 0
+        if busy:
+            job.overruns += 1
+            Metrics.JOB_OVERRUNS.inc(job.name)
+            log(f"!! '{job.name}' still running at its deadline, skipping this run.")
+            return
+        if now - when > job.interval:
+            job.skipped += 1
+            return
 
-        # 3. Sleep for the interval
-        time.sleep(interval_minutes * 60)
+        try:
+            tasks = list(job.tasks())
+        except Exception as e:
+            log(f"!! Error in '{job.name}': {e}")
+            job.errors += 1
+            Metrics.JOB_ERRORS.inc(job.name)
+            return
+
+        job.runs += 1
+        job.lags.append(now - when)
+        Metrics.JOB_RUNS.inc(job.name)
+        Metrics.JOB_LAG.observe(now - when, job.name)
+        if job.last_start is not None:
+            job.cadences.append(now - job.last_start)
+        job.last_start = job.started = now
+        job.capture = self.profiler.begin(job.name) if self.profiler else None
+
+        if not tasks:
+            self.finishRun(job)
+            return
+
+        job.pending = len(tasks)
+        step = job.interval * job.spread / len(tasks)
+        for i, task in enumerate(tasks):
+            self.push(when + i * step, self.submit, job, task)
+
+    def submit(self, job, when, task):
+        self.pool.submit(self.runTask, job, task)
+
+    def runTask(self, job, task):
+        try:
+            if job.capture:
+                job.capture.run(task)
+            else:
+                task()
+        except Exception as e:
+            log(f"!! Error in '{job.name}': {e}")
+            job.errors += 1
+            Metrics.JOB_ERRORS.inc(job.name)
+        finally:
+            Metrics.JOB_ITEMS.inc(job.name)
+            with self.cond:
+                job.pending -= 1
+                done = job.pending == 0
+            if done:
+                self.finishRun(job)
+
+    def finishRun(self, job):
+        try:
+            if job.finish:
+                job.finish()
+        except Exception as e:
+            log(f"!! Error in '{job.name}': {e}")
+            job.errors += 1
+            Metrics.JOB_ERRORS.inc(job.name)
+        job.durations.append(time.monotonic() - job.started)
+        Metrics.JOB_SECONDS.observe(job.durations[-1], job.name)
+
+        capture, job.capture = job.capture, None
+        if capture:
+            try:
+                capture.end()
+            except Exception as e:
+                log(f"!! Could not write profile for '{job.name}': {e}")
+
+    def report(self):
+        # Actual cadence and lag per job since the last report, then reset
+        for job in self.jobs:
+            def avg(xs):
+                return f"{sum(xs) / len(xs):.1f}s" if xs else "-"
+            log(f"[{job.name}] runs={job.runs} cadence={avg(job.cadences)} (target {job.interval:.0f}s) "
+                f"lag={avg(job.lags)} max_lag={max(job.lags, default=0):.1f}s duration={avg(job.durations)} "
+                f"overruns={job.overruns} skipped={job.skipped} errors={job.errors}")
+            job.runs = job.overruns = job.skipped = job.errors = 0
+            job.lags, job.cadences, job.durations = [], [], []
 
 
 def main():
@@ -82,53 +314,103 @@ def main():
 
     internet_event.set()  # Green light!
 
+    if METRICS_PORT:
+        try:
+            Metrics.serve(METRICS_PORT)
+            log(f"Metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
+        except OSError as e:
+            log(f"!! Metrics endpoint disabled: {e}")
+
     # 2. Initialize Session
     try:
-        token = get_valid_token()
-        session = FetchSession(token=token)
+        # Several keys, cached on disk across restarts; re-login only when they stop working
+        keys = KeyManager().load()
+        session = FetchSession(keys=keys)
     except Exception as e:
-        log(f"CRITICAL: Failed to get initial token: {e}")
+        log(f"CRITICAL: Failed to get initial API keys: {e}")
         # In a real infinite script, we might want to loop here too,
         # but if we can't login at boot, something is wrong with config.
         sys.exit(1)
 
-    # 3. Initialize Clans
-    clans = []
-    log(f"Loading {len(clan_tags)} clans...")
-    for tag in clan_tags:
-        try:
-            clans.append(clan(tag, session))
-        except Exception as e:
-            log(f"Skipping clan {tag}: {e}")
+    # Pending schema migrations (new tables, indexes) before any job runs; jobs can't work without them
+    if not migrate(session.db):
+        log("CRITICAL: Schema migration failed. Fix it (python Migrations.py) and restart.")
+        sys.exit(1)
+    session.index.warm()
+    session.states.warm()
+
+    # 3. Claim this worker's shard (everything when unsharded)
+    shard = LeaseManager(session.db, clan_tags).start() if SHARDED else AllClans(clan_tags)
+
+    # 4. Initialize Clans (warm start; anything unknown is crawled in the background)
+    clans, cold = load_clans(session, shard)
+    log(f"Warm-started {len(clans)} clans, {len(cold)} to crawl in the background...")
+    threading.Thread(target=refresh_rosters, args=(clans, cold, session, shard), daemon=True).start()
+
+    # 5. Define Jobs (one task per owned clan, spread across the interval)
+    def owned_clans():
+        return [c for c in list(clans) if shard.owns(c.clanTag)]
 
-    # 4. Define Job Wrappers
     def job_activity():
-        for c in clans: c.savePlayersActivity()
+        return [serially(c, c.savePlayersActivity) for c in owned_clans()]
 
     def job_snapshot():
-        for c in clans: c.savePlayersSnapshot()
+        # Clans claimed after boot that were never crawled get built here
+        known = {c.clanTag for c in list(clans)}
+        missing = [t for t in shard.tags() if t not in known]
+        return ([serially(c, c.savePlayersSnapshot) for c in owned_clans()] +
+                [lambda t=t: build_clan(t, session, clans) for t in missing])
 
-    def job_war_status():
-        for t in clan_tags: clanWar(session, t)
+    def job_wars():
+        # One currentwar fetch per clan feeds ClanWar, WarPlayer, Attack and WarResults
+        return [lambda t=t: clanWar.ingestAll(session, [t]) for t in shard.tags()]
 
     def job_war_results():
-        warResults.checkWarEnded(session)
+        # Global backstop: one worker is enough
+        return [lambda: warResults.checkWarEnded(session)] if shard.isLeader() else []
+
+    rollups = RollupManager(session.db)
+
+    def job_rollups():
+        return [rollups.run, rollups.prune] if shard.isLeader() else []
+
+    # 6. Start the scheduler (its threads are daemons, so they die with the main script)
+    # Profile a job at runtime: `echo "Snapshot 3" > profile.request`, or SIGUSR1 (PROFILE_JOB)
+    profiler = Profiler()
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, profiler.onSignal)
+    scheduler = Scheduler(WORKERS, profiler)
+    scheduler.add("Activity", 5, job_activity)
+    scheduler.add("Snapshot", 60, job_snapshot, finish=lambda: save_checkpoint(clans))
+    scheduler.add("Wars", 10, job_wars)
+    scheduler.add("WarResults", 5, job_war_results)
+    scheduler.add("Rollups", 15, job_rollups)
+    scheduler.start()
 
-    def job_attacks():
-        attack.saveAttacks(session)
+    log("All systems GO. Monitoring connection...")
 
-    # 5. Launch Threads (Daemon=True ensures they die if main script is killed)
-    threading.Thread(target=run_job_safe, args=(5, job_activity, "Activity"), daemon=True).start()
-    threading.Thread(target=run_job_safe, args=(60, job_snapshot, "Snapshot"), daemon=True).start()
-    threading.Thread(target=run_job_safe, args=(30, job_war_status, "WarStatus"), daemon=True).start()
-    threading.Thread(target=run_job_safe, args=(5, job_war_results, "WarResults"), daemon=True).start()
-    threading.Thread(target=run_job_safe, args=(10, job_attacks, "Attacks"), daemon=True).start()
+    # SIGTERM (e.g. systemd/screen shutdown) unwinds like Ctrl+C so the checkpoint gets written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        watchdog(scheduler, session)
+    finally:
+        log("Shutting down, writing checkpoint...")
+        save_checkpoint(clans)
+        shard.stop()
 
-    log("All systems GO. Monitoring connection...")
 
-    # 6. Infinite Watchdog Loop
+def watchdog(scheduler, session, report_minutes=15):
+    # 7. Infinite Watchdog Loop
+    last_report = time.monotonic()
     while True:
         time.sleep(10)
+        if scheduler.profiler:
+            scheduler.profiler.poll()
+
+        if time.monotonic() - last_report >= report_minutes * 60:
+            scheduler.report()
+            log(f"[API] {session.limiter.stats()} cache={session.cache.stats()}")
+            last_report = time.monotonic()
 
         is_connected = check_internet_connection()
 